@@ -4,12 +4,13 @@ Handles library-specific admin functions
 """
 
 import os
+import re
 from functools import wraps
 from datetime import datetime, date, timedelta
-from flask import Blueprint, render_template, request, redirect, url_for, flash, g, jsonify
+from flask import Blueprint, render_template, request, redirect, url_for, flash, g, jsonify, Response, current_app
 from flask_login import login_required, current_user
 from werkzeug.utils import secure_filename
-from models import db, Library, Seat, SystemSettings, Booking, User, LibraryAdmin, AdminRole, BookingStatus, SeatCategory, ApprovalStatus, GalleryImage, GalleryStatus
+from models import db, Library, Seat, SystemSettings, Booking, BookingRollup, User, LibraryAdmin, AdminRole, BookingStatus, SeatCategory, ApprovalStatus, GalleryImage, GalleryStatus
 from sqlalchemy import func, and_, extract
 
 admin_bp = Blueprint('admin', __name__, url_prefix='/admin')
@@ -18,6 +19,9 @@ admin_bp = Blueprint('admin', __name__, url_prefix='/admin')
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
 MAX_FILE_SIZE = 5 * 1024 * 1024  # 5MB
 
+# Most items a single bulk check-in may carry
+MAX_BULK_CHECKIN_ITEMS = 500
+
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
@@ -35,7 +39,8 @@ def library_admin_required(f):
         
         # Get library
         if isinstance(slug, str):
-            library = Library.query.filter_by(slug=slug).first()
+            from services.library_cache import LibraryCache
+            library = LibraryCache.get_by_slug(slug)
         else:
             library = slug
             
@@ -89,7 +94,9 @@ def dashboard(slug):
     ).order_by(Booking.created_at.desc()).limit(10).all()
     
     # Get settings
-    settings = SystemSettings.query.filter_by(library_id=library.id).first()
+    from services.settings_registry import SettingsRegistry
+    schedule = SettingsRegistry.get(library.id)
+    settings = schedule.settings if schedule else None
     
     # Get pending users count
     pending_count = User.query.filter_by(
@@ -117,9 +124,7 @@ def manage_seats(slug):
     library = g.admin_library
     
     # Get all seats
-    seats = Seat.query.filter_by(library_id=library.id).order_by(
-        Seat.number.cast(db.Integer)
-    ).all()
+    seats = Seat.query.filter_by(library_id=library.id).order_by(Seat.sort_key).all()
     
     # Get booking counts for each seat
     seat_stats = {}
@@ -149,6 +154,9 @@ def toggle_maintenance(slug, seat_id):
     seat.in_maintenance = not seat.in_maintenance
     db.session.commit()
     
+    from services.availability_service import AvailabilityService
+    AvailabilityService.invalidate_roster(library.id)
+    
     status = "under maintenance" if seat.in_maintenance else "available"
     flash(f'Seat {seat.number} is now {status}', 'success')
     
@@ -197,6 +205,11 @@ def manage_settings(slug):
         settings.maintenance_mode = maintenance_mode
         
         db.session.commit()
+        
+        from services.settings_registry import SettingsRegistry
+        from services.availability_service import AvailabilityService
+        SettingsRegistry.invalidate(library.id)
+        AvailabilityService.invalidate(library.id)
         flash('Settings updated successfully', 'success')
         return redirect(url_for('admin.manage_settings', slug=slug))
     
@@ -212,33 +225,32 @@ def reports(slug):
     days = request.args.get('days', 30, type=int)
     start_date = date.today() - timedelta(days=days)
     
-    # Total bookings in period
-    total_bookings = Booking.query.filter(
-        Booking.library_id == library.id,
-        Booking.date >= start_date
-    ).count()
+    # Counts come from the booking rollup rather than the booking table
+    in_period = and_(
+        BookingRollup.library_id == library.id,
+        BookingRollup.date >= start_date
+    )
     
     # Bookings by status
     bookings_by_status = db.session.query(
-        Booking.status,
-        func.count(Booking.id)
-    ).filter(
-        Booking.library_id == library.id,
-        Booking.date >= start_date
-    ).group_by(Booking.status).all()
+        BookingRollup.status,
+        func.sum(BookingRollup.count)
+    ).filter(in_period).group_by(BookingRollup.status).all()
     
     status_stats = {status.value: 0 for status in BookingStatus}
     for status, count in bookings_by_status:
         status_stats[status.value] = count
     
+    # Total bookings in period
+    total_bookings = sum(status_stats.values())
+    
     # Daily bookings for chart
     daily_bookings = db.session.query(
-        Booking.date,
-        func.count(Booking.id)
-    ).filter(
-        Booking.library_id == library.id,
-        Booking.date >= start_date
-    ).group_by(Booking.date).order_by(Booking.date).all()
+        BookingRollup.date,
+        func.sum(BookingRollup.count)
+    ).filter(in_period).group_by(BookingRollup.date).having(
+        func.sum(BookingRollup.count) > 0
+    ).order_by(BookingRollup.date).all()
     
     # Seat utilization
     seat_utilization = db.session.query(
@@ -250,13 +262,15 @@ def reports(slug):
     ).group_by(Seat.id).order_by(func.count(Booking.id).desc()).limit(10).all()
     
     # Peak hours
-    peak_hours = db.session.query(
-        func.strftime('%H', Booking.time_slot).label('hour'),
-        func.count(Booking.id)
-    ).filter(
-        Booking.library_id == library.id,
-        Booking.date >= start_date
-    ).group_by('hour').order_by(func.count(Booking.id).desc()).all()
+    peak_hours = [
+        (f'{hour:02d}', count)
+        for hour, count in db.session.query(
+            BookingRollup.hour,
+            func.sum(BookingRollup.count)
+        ).filter(in_period).group_by(BookingRollup.hour).having(
+            func.sum(BookingRollup.count) > 0
+        ).order_by(func.sum(BookingRollup.count).desc()).all()
+    ]
     
     # Top users
     top_users = db.session.query(
@@ -385,9 +399,20 @@ def cancel_user_booking(slug, booking_id):
         flash('Only active bookings can be cancelled', 'error')
         return redirect(url_for('admin.all_bookings', slug=slug))
     
+    from services.booking_rollup import BookingRollupService
     booking.status = BookingStatus.cancelled
+    BookingRollupService.status_changed(booking, BookingStatus.booked)
     db.session.commit()
     
+    from services.availability_service import AvailabilityService
+    from services.expiry_wheel import NoShowExpiryWheel
+    from services.checkin_hub import CheckinHub
+    from services.analytics_cache import AnalyticsCache
+    AvailabilityService.release_booking(booking)
+    NoShowExpiryWheel.discard(booking.id)
+    CheckinHub.bookings_cancelled(library.id, [booking.id])
+    AnalyticsCache.invalidate()
+    
     flash(f'Booking #{booking.id} has been cancelled', 'success')
     return redirect(url_for('admin.all_bookings', slug=slug))
 
@@ -534,6 +559,8 @@ def approve_user(slug, user_id):
         user.approved_by = current_user.id
         user.approved_at = datetime.utcnow()
         
+        from services.user_session import UserSessionService
+        UserSessionService.invalidate(user.id)
         db.session.commit()
         
         # Send approval email
@@ -575,6 +602,8 @@ def reject_user(slug, user_id):
     user.approved_by = current_user.id
     user.approved_at = datetime.utcnow()
     
+    from services.user_session import UserSessionService
+    UserSessionService.invalidate(user.id)
     db.session.commit()
     
     flash(f'User {user.username} has been rejected', 'info')
@@ -629,6 +658,8 @@ def gallery(slug):
             
             db.session.add(gallery_image)
             db.session.commit()
+            from services.analytics_cache import AnalyticsCache
+            AnalyticsCache.invalidate()
             
             flash('Photo uploaded! Waiting for CSR admin approval.', 'success')
             return redirect(url_for('admin.gallery', slug=slug))
@@ -663,6 +694,8 @@ def delete_gallery_image(slug, image_id):
     
     db.session.delete(image)
     db.session.commit()
+    from services.analytics_cache import AnalyticsCache
+    AnalyticsCache.invalidate()
     
     flash('Photo deleted successfully', 'success')
     return redirect(url_for('admin.gallery', slug=slug))
@@ -807,7 +840,7 @@ def bulk_cancel_bookings(slug):
         library.id, booking_date
     )
     
-    flash(f'✅ Cancelled {count} bookings for {date_str}. Email notifications sent to all users.', 'success')
+    flash(f'✅ Cancelled {count} bookings for {date_str}. Email notifications are being sent to all users.', 'success')
     return redirect(url_for('admin.bulk_operations', slug=slug))
 
 # ============= USER REPORTING / CHECK-IN SYSTEM =============
@@ -820,8 +853,12 @@ def user_reporting(slug):
     
     library = g.admin_library
     
-    # Get pending reports (users who need to check in)
-    pending_reports = ReportingService.get_pending_reports(library.id)
+    # Get pending reports (users who need to check in); expired ones are
+    # about to be auto-cancelled and are left off the desk
+    pending_reports = [
+        item for item in ReportingService.get_pending_reports(library.id)
+        if item.can_report
+    ]
     
     # Get users who reported today
     reported_today = ReportingService.get_reported_today(library.id)
@@ -839,6 +876,54 @@ def user_reporting(slug):
         upcoming_count=len(upcoming)
     )
 
+@admin_bp.route('/<slug>/reporting/stream')
+@library_admin_required
+def reporting_stream(slug):
+    """Server-Sent Events feed that keeps the reporting desk up to date"""
+    from services.checkin_hub import CheckinHub
+    
+    library_id = g.admin_library.id
+    subscriber = CheckinHub.subscribe(library_id, current_app.config['CHECKIN_MAX_STREAMS'])
+    if subscriber is None:
+        # The page falls back to polling reporting_state
+        return Response('Live updates are at capacity', status=503, mimetype='text/plain')
+    
+    return Response(
+        CheckinHub.stream(library_id, subscriber),
+        mimetype='text/event-stream',
+        headers={
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no'  # Stop nginx from buffering the stream
+        }
+    )
+
+@admin_bp.route('/<slug>/reporting/state')
+@library_admin_required
+def reporting_state(slug):
+    """Current pending and reported cards, fetched by the desk whenever its stream connects"""
+    from services.reporting_service import ReportingService
+    from services.checkin_hub import CheckinHub
+    
+    library_id = g.admin_library.id
+    return jsonify({
+        'server_time': datetime.now().isoformat(timespec='seconds'),
+        'pending': [
+            CheckinHub.pending_item(
+                item.booking_id, item.username, item.seat_number,
+                item.slot_start, item.grace_end
+            )
+            for item in ReportingService.get_pending_reports(library_id)
+            if item.can_report
+        ],
+        'reported': [
+            CheckinHub.reported_item(
+                row.booking_id, row.username, row.seat_number,
+                row.time_slot, row.reported_at
+            )
+            for row in ReportingService.get_reported_today(library_id)
+        ]
+    })
+
 @admin_bp.route('/<slug>/reporting/mark', methods=['POST'])
 @library_admin_required
 def mark_reported(slug):
@@ -859,6 +944,94 @@ def mark_reported(slug):
     
     return redirect(url_for('admin.user_reporting', slug=slug))
 
+@admin_bp.route('/<slug>/reporting/mark-bulk', methods=['POST'])
+@library_admin_required
+def mark_reported_bulk(slug):
+    """
+    Mark many users as reported in one call. Accepts JSON
+    {"booking_ids": [...], "seat_numbers": [...]} and answers with a result
+    per item, or the reporting page's form (checked cards plus a list of
+    seat numbers) and flashes a summary.
+    """
+    from services.reporting_service import ReportingService
+
+    if request.is_json:
+        data = request.get_json(silent=True) or {}
+        booking_ids = data.get('booking_ids') or []
+        seat_numbers = data.get('seat_numbers') or []
+    else:
+        booking_ids = request.form.getlist('booking_ids')
+        seat_numbers = re.split(r'[\s,]+', request.form.get('seat_numbers', ''))
+
+    def reject(message):
+        if request.is_json:
+            return jsonify({'error': message}), 400
+        flash(f'❌ {message}', 'error')
+        return redirect(url_for('admin.user_reporting', slug=slug))
+
+    try:
+        booking_ids = [int(booking_id) for booking_id in booking_ids]
+    except (TypeError, ValueError):
+        return reject('Invalid booking selection: booking IDs must be integers')
+    seat_numbers = [str(number) for number in seat_numbers if str(number).strip()]
+
+    if len(booking_ids) + len(seat_numbers) > MAX_BULK_CHECKIN_ITEMS:
+        return reject(f'At most {MAX_BULK_CHECKIN_ITEMS} bookings can be checked in at once')
+
+    results = ReportingService.bulk_mark_reported(
+        g.admin_library.id, current_user.id,
+        booking_ids=booking_ids, seat_numbers=seat_numbers
+    )
+    marked = sum(1 for result in results if result['success'])
+
+    if request.is_json:
+        return jsonify({
+            'marked': marked,
+            'failed': len(results) - marked,
+            'results': results
+        })
+
+    if marked:
+        flash(f'✅ Marked {marked} user(s) as reported', 'success')
+    for result in results:
+        if not result['success']:
+            flash(f"❌ {result['item']}: {result['message']}", 'error')
+    if not results:
+        flash('Select bookings or enter seat numbers to check in', 'info')
+
+    return redirect(url_for('admin.user_reporting', slug=slug))
+
+@admin_bp.route('/<slug>/kiosk')
+@library_admin_required
+def checkin_kiosk(slug):
+    """Full-screen QR check-in kiosk for the library entrance"""
+    return render_template('admin_kiosk.html', library=g.admin_library)
+
+@admin_bp.route('/<slug>/kiosk/checkin', methods=['POST'])
+@library_admin_required
+def kiosk_checkin(slug):
+    """Check a user in from a scanned QR token (JSON API used by the kiosk)"""
+    from services.reporting_service import ReportingService
+
+    data = request.get_json(silent=True) or {}
+    token = data.get('token') or request.form.get('token', '')
+
+    success, message, claims = ReportingService.mark_reported_by_token(
+        token, g.admin_library.id, current_user.id
+    )
+
+    result = {'success': success, 'message': message}
+    if claims is None:
+        # Unreadable or forged code
+        return jsonify(result), 400
+
+    result.update({
+        'booking_id': claims.booking_id,
+        'seat_number': claims.seat_number,
+        'time_slot': claims.slot_start.strftime('%I:%M %p')
+    })
+    return jsonify(result), 200 if success else 409
+
 @admin_bp.route('/<slug>/reporting/auto-cancel', methods=['POST'])
 @library_admin_required
 def run_auto_cancel(slug):
@@ -7,8 +7,14 @@ from flask_login import LoginManager, login_user, logout_user, login_required, c
 from flask_migrate import Migrate
 from flask_mail import Mail
 from config import Config
-from models import db, User, Library, Seat, SystemSettings, Booking, BookingStatus, SeatCategory, ApprovalStatus
-from sqlalchemy import and_, or_
+from models import db, User, Library, Seat, SystemSettings, Booking, BookingStatus, SeatCategory, ApprovalStatus, BOOKING_USER_SLOT_INDEX
+from sqlalchemy import and_, or_, func
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import joinedload
+from services.settings_registry import SettingsRegistry, generate_time_slots
+from services.expiry_wheel import NoShowExpiryWheel
+from services.checkin_hub import CheckinHub
+from services.analytics_cache import AnalyticsCache
 
 # Initialize Flask extensions
 login_manager = LoginManager()
@@ -44,6 +50,52 @@ def run_auto_migration(app):
                 return False
         return False
 
+def run_schema_upgrades(app):
+    """Bring an existing database up to date with the current models"""
+    with app.app_context():
+        try:
+            from migrate import run_schema_upgrades as upgrade
+        except ImportError:
+            print("⚠️  migrate.py not found. Skipping schema upgrades.\n")
+            return False
+        upgrade()
+        return True
+
+# URL patterns used to detect the current library
+LIBRARY_PATH_RE = re.compile(r'^/([a-z0-9-]+)/')
+MICROSITE_PATH_RE = re.compile(r'^/libraries/([a-z0-9-]+)')
+RESERVED_PATH_PREFIXES = frozenset([
+    'login', 'register', 'logout', 'static', 'libraries', 'switch-library',
+    'health', 'bookings', 'admin', 'csr-admin'
+])
+
+# Flash messages for booking conflicts
+SEAT_TAKEN_MESSAGE = 'This seat is already booked for the selected time slot'
+USER_SLOT_TAKEN_MESSAGE = 'You already have a booking for this time slot'
+
+def is_user_slot_conflict(error):
+    """True if an IntegrityError came from the one-active-booking-per-user-slot index"""
+    message = str(error.orig)
+    # PostgreSQL names the index; SQLite lists the indexed columns
+    return BOOKING_USER_SLOT_INDEX in message or 'booking.user_id' in message
+
+def queue_booking_email(booking, kind):
+    """
+    Queue a booking confirmation or cancellation email in the current
+    transaction. A failure to render or queue it is logged and rolled back
+    to a savepoint, so it never undoes the booking change itself.
+    """
+    from services.email_service import EmailService
+    queue = {
+        'confirmation': EmailService.queue_booking_confirmation,
+        'cancellation': EmailService.queue_cancellation_email,
+    }[kind]
+    try:
+        with db.session.begin_nested():
+            queue(booking)
+    except Exception as e:
+        print(f"Email error: {e}")
+
 def library_context_required(f):
     """Decorator to ensure library context is set"""
     @wraps(f)
@@ -68,18 +120,6 @@ def approval_required(f):
         return f(*args, **kwargs)
     return decorated_function
 
-def generate_time_slots(opening_time, closing_time, slot_duration):
-    """Generate list of time slots based on library settings"""
-    slots = []
-    current = datetime.combine(date.today(), opening_time)
-    end = datetime.combine(date.today(), closing_time)
-    
-    while current < end:
-        slots.append(current.time())
-        current += timedelta(minutes=slot_duration)
-    
-    return slots
-
 def create_app(config_name='development'):
     """Application factory pattern"""
     app = Flask(__name__)
@@ -128,14 +168,18 @@ def create_app(config_name='development'):
     
     @login_manager.user_loader
     def load_user(user_id):
-        """Load user by ID for Flask-Login"""
-        return User.query.get(int(user_id))
+        """Load user by ID for Flask-Login, from the session snapshot when fresh"""
+        from services.user_session import UserSessionService
+        return UserSessionService.load_user(int(user_id))
     
     # Create database tables on first run
     with app.app_context():
         db.create_all()
         print("✓ Database tables created successfully")
         
+        # Add columns/indexes introduced after the tables were created
+        run_schema_upgrades(app)
+        
         # Run auto-migration if needed
         run_auto_migration(app)
     
@@ -147,22 +191,28 @@ def create_app(config_name='development'):
         # Extract library slug from path
         path = request.path
         
+        # Static files and the health check never carry a library
+        if path.startswith('/static/') or path == '/health':
+            return
+        
+        from services.library_cache import LibraryCache
+        
         # Pattern 1: /slug/... (e.g., /bpsmv/dashboard)
-        match = re.match(r'^/([a-z0-9-]+)/', path)
+        match = LIBRARY_PATH_RE.match(path)
         if match:
             slug = match.group(1)
             # Skip common routes that aren't library slugs
-            if slug not in ['login', 'register', 'logout', 'static', 'libraries', 'switch-library', 'health', 'bookings', 'admin', 'csr-admin']:
-                library = Library.query.filter_by(slug=slug).first()
+            if slug not in RESERVED_PATH_PREFIXES:
+                library = LibraryCache.get_by_slug(slug)
                 if library:
                     g.current_library = library
                     return
         
         # Pattern 2: /libraries/slug (e.g., /libraries/bpsmv)
-        match = re.match(r'^/libraries/([a-z0-9-]+)', path)
+        match = MICROSITE_PATH_RE.match(path)
         if match:
             slug = match.group(1)
-            library = Library.query.filter_by(slug=slug).first()
+            library = LibraryCache.get_by_slug(slug)
             if library:
                 g.current_library = library
     
@@ -179,15 +229,12 @@ def create_app(config_name='development'):
         show_rules = False
         
         if current_user.is_authenticated and hasattr(g, 'current_library') and g.current_library:
-            from models import UserRulesAcknowledgment
+            from services.user_session import UserSessionService
             
             # Check if user has acknowledged rules for this library
-            ack = UserRulesAcknowledgment.query.filter_by(
-                user_id=current_user.id,
-                library_id=g.current_library.id
-            ).first()
+            acknowledged = UserSessionService.get_acknowledged_libraries(current_user.id)
             
-            show_rules = (ack is None)  # Show if not acknowledged
+            show_rules = g.current_library.id not in acknowledged  # Show if not acknowledged
         
         return {'show_rules_modal': show_rules}
     
@@ -211,24 +258,28 @@ def create_app(config_name='development'):
         # Show public home page for anonymous users
         from models import GalleryImage, GalleryStatus
         
+        from services.analytics import AnalyticsService
+        
         # Get all libraries
         libraries = Library.query.all()
         
-        # Enhance with counts
+        # Enhance with counts (one grouped query)
+        seat_counts = dict(db.session.query(
+            Seat.library_id, func.count(Seat.id)
+        ).group_by(Seat.library_id).all())
         for library in libraries:
-            library.total_seats = Seat.query.filter_by(library_id=library.id).count()
+            library.total_seats = seat_counts.get(library.id, 0)
         
-        # Get network stats
-        total_libraries = Library.query.count()
-        total_seats = Seat.query.count()
-        total_users = User.query.filter_by(is_active=True).count()
+        # Get network stats (one statement, cached briefly; booking writes
+        # do not clear it since the page shows no booking figures)
+        summary = AnalyticsCache.get_public(AnalyticsService.get_public_summary)
         
         return render_template(
             'public_home.html',
             libraries=libraries,
-            total_libraries=total_libraries,
-            total_seats=total_seats,
-            total_users=total_users
+            total_libraries=summary['total_libraries'],
+            total_seats=summary['total_seats'],
+            total_users=summary['active_users']
         )
     
     @app.route('/libraries/<slug>')
@@ -293,6 +344,8 @@ def create_app(config_name='development'):
             
             # Login successful
             login_user(user, remember=True)
+            from services.user_session import UserSessionService
+            UserSessionService.store(user)
             flash(f'Welcome back, {user.username}!', 'success')
             
             # CSR Super Admins go to CSR Admin panel
@@ -388,7 +441,9 @@ def create_app(config_name='development'):
     @login_required
     def logout():
         """Logout user"""
+        from services.user_session import UserSessionService
         logout_user()
+        UserSessionService.clear()
         flash('You have been logged out successfully', 'info')
         return redirect(url_for('login'))
     
@@ -413,20 +468,25 @@ def create_app(config_name='development'):
     def acknowledge_rules():
         """Acknowledge library rules"""
         from models import UserRulesAcknowledgment
+        from services.library_cache import LibraryCache
+        from services.user_session import UserSessionService
         
-        data = request.get_json()
+        data = request.get_json(silent=True) or {}
         library_id = data.get('library_id')
         
         if not library_id:
             return jsonify({'success': False, 'error': 'Library ID required'}), 400
         
-        # Check if already acknowledged
-        existing = UserRulesAcknowledgment.query.filter_by(
-            user_id=current_user.id,
-            library_id=library_id
-        ).first()
+        try:
+            library_id = int(library_id)
+        except (TypeError, ValueError):
+            return jsonify({'success': False, 'error': 'Invalid library ID'}), 400
+        
+        if LibraryCache.get_by_id(library_id) is None:
+            return jsonify({'success': False, 'error': 'Library not found'}), 404
         
-        if existing:
+        # Check if already acknowledged
+        if library_id in UserSessionService.get_acknowledged_libraries(current_user.id):
             return jsonify({'success': True, 'message': 'Already acknowledged'})
         
         # Create acknowledgment
@@ -437,7 +497,13 @@ def create_app(config_name='development'):
         )
         
         db.session.add(ack)
-        db.session.commit()
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # Acknowledged from another tab since the session set was loaded
+            db.session.rollback()
+        
+        UserSessionService.add_acknowledged_library(current_user.id, library_id)
         
         return jsonify({'success': True, 'message': 'Rules acknowledged'})
     
@@ -464,14 +530,10 @@ def create_app(config_name='development'):
             status=BookingStatus.booked
         ).filter(Booking.date >= date.today()).count()
         
-        # Get system settings
-        settings = SystemSettings.query.filter_by(library_id=library.id).first()
-        
-        # Calculate total slots per day
-        total_slots = 0
-        if settings:
-            hours = settings.closing_time.hour - settings.opening_time.hour
-            total_slots = (hours * 60) // settings.slot_duration
+        # Get system settings and slots per day
+        schedule = SettingsRegistry.get(library.id)
+        settings = schedule.settings if schedule else None
+        total_slots = schedule.slots_per_day if schedule else 0
         
         return render_template(
             'dashboard.html',
@@ -499,18 +561,14 @@ def create_app(config_name='development'):
         except:
             selected_date = date.today()
         
-        # Get system settings
-        settings = SystemSettings.query.filter_by(library_id=library.id).first()
-        if not settings:
+        # Get system settings and the library's slot grid
+        schedule = SettingsRegistry.get(library.id)
+        if not schedule:
             flash('Library settings not configured', 'error')
             return redirect(url_for('dashboard', slug=slug))
         
-        # Generate time slots
-        time_slots = generate_time_slots(
-            settings.opening_time,
-            settings.closing_time,
-            settings.slot_duration
-        )
+        settings = schedule.settings
+        time_slots = schedule.slots
         
         # Set selected time slot
         selected_time = None
@@ -523,35 +581,11 @@ def create_app(config_name='development'):
         if not selected_time and time_slots:
             selected_time = time_slots[0]
         
-        # Get all seats for this library
-        all_seats = Seat.query.filter_by(library_id=library.id).order_by(
-            Seat.number.cast(db.Integer)
-        ).all()
-        
-        # Get bookings for selected date and time
-        booked_seat_ids = []
-        if selected_time:
-            bookings = Booking.query.filter_by(
-                library_id=library.id,
-                date=selected_date,
-                time_slot=selected_time,
-                status=BookingStatus.booked
-            ).all()
-            booked_seat_ids = [b.seat_id for b in bookings]
-        
-        # Build seat status map
-        seats_data = []
-        for seat in all_seats:
-            status = 'maintenance' if seat.in_maintenance else (
-                'booked' if seat.id in booked_seat_ids else 'available'
-            )
-            seats_data.append({
-                'id': seat.id,
-                'number': seat.number,
-                'category': seat.category.value,
-                'status': status,
-                'in_maintenance': seat.in_maintenance
-            })
+        # Build seat status map from the cached seat roster and day grid
+        from services.availability_service import AvailabilityService
+        seats_data = AvailabilityService.get_seat_map(
+            library.id, selected_date, selected_time, time_slots
+        )
         
         return render_template(
             'seats.html',
@@ -563,6 +597,26 @@ def create_app(config_name='development'):
             today=date.today()
         )
     
+    @app.route('/<slug>/seats/availability', methods=['GET'])
+    @login_required
+    @approval_required
+    @library_context_required
+    def seats_availability(slug):
+        """Full-day seat x slot availability matrix (JSON) for the seat map"""
+        library = g.current_library
+        
+        try:
+            selected_date = datetime.fromisoformat(request.args.get('date', '')).date()
+        except ValueError:
+            selected_date = date.today()
+        
+        schedule = SettingsRegistry.get(library.id)
+        if not schedule:
+            return jsonify({'error': 'Library settings not configured'}), 404
+        
+        from services.availability_service import AvailabilityService
+        return jsonify(AvailabilityService.get_day_matrix(library.id, selected_date, schedule.slots))
+    
     @app.route('/<slug>/book', methods=['POST'])
     @login_required
     @approval_required
@@ -593,14 +647,17 @@ def create_app(config_name='development'):
             flash('Cannot book seats for past dates', 'error')
             return redirect(url_for('seats', slug=slug, date=booking_date_str, time_slot=time_slot_str))
         
-        # Get seat
-        seat = Seat.query.filter_by(id=seat_id, library_id=library.id).first()
+        # Get seat from the cached roster
+        from services.availability_service import AvailabilityService
+        seat = AvailabilityService.get_seat(library.id, seat_id)
         if not seat:
             flash('Invalid seat selected', 'error')
             return redirect(url_for('seats', slug=slug))
         
+        _, seat_number, seat_category, seat_in_maintenance = seat
+        
         # Check if seat is in maintenance
-        if seat.in_maintenance:
+        if seat_in_maintenance:
             flash('This seat is currently under maintenance', 'error')
             return redirect(url_for('seats', slug=slug, date=booking_date_str, time_slot=time_slot_str))
         
@@ -608,45 +665,28 @@ def create_app(config_name='development'):
         from models import UserRole
         
         # Researcher seats - only for researchers
-        if seat.category == SeatCategory.researcher:
+        if seat_category == SeatCategory.researcher.value:
             if not hasattr(current_user, 'user_role') or current_user.user_role != UserRole.researcher:
                 if not current_user.is_csr_super_admin:
                     flash('🔬 This seat is reserved for researchers only', 'error')
                     return redirect(url_for('seats', slug=slug, date=booking_date_str, time_slot=time_slot_str))
         
         # Staff seats - only for staff
-        if seat.category == SeatCategory.staff:
+        if seat_category == SeatCategory.staff.value:
             if not hasattr(current_user, 'user_role') or current_user.user_role != UserRole.staff:
                 if not current_user.is_csr_super_admin:
                     flash('👔 This seat is reserved for staff only', 'error')
                     return redirect(url_for('seats', slug=slug, date=booking_date_str, time_slot=time_slot_str))
         
-        # Check if seat is already booked for this slot
-        existing_booking = Booking.query.filter_by(
-            seat_id=seat_id,
-            date=booking_date,
-            time_slot=booking_time,
-            status=BookingStatus.booked
-        ).first()
-        
-        if existing_booking:
-            flash('This seat is already booked for the selected time slot', 'error')
+        # Fast rejection from the in-memory grid; the unique indexes below
+        # remain the source of truth
+        if AvailabilityService.is_booked(library.id, booking_date, seat_id, booking_time):
+            flash(SEAT_TAKEN_MESSAGE, 'error')
             return redirect(url_for('seats', slug=slug, date=booking_date_str, time_slot=time_slot_str))
         
-        # Check if user already has a booking for this time slot
-        user_existing_booking = Booking.query.filter_by(
-            user_id=current_user.id,
-            library_id=library.id,
-            date=booking_date,
-            time_slot=booking_time,
-            status=BookingStatus.booked
-        ).first()
-        
-        if user_existing_booking:
-            flash('You already have a booking for this time slot', 'error')
-            return redirect(url_for('seats', slug=slug, date=booking_date_str, time_slot=time_slot_str))
-        
-        # Create booking
+        # Create booking in a single INSERT. The partial unique indexes on
+        # active bookings reject a taken seat or a second booking by this
+        # user for the slot atomically, even under concurrent clicks.
         booking = Booking(
             library_id=library.id,
             user_id=current_user.id,
@@ -657,16 +697,34 @@ def create_app(config_name='development'):
         )
         
         db.session.add(booking)
-        db.session.commit()
-        
-        # Send confirmation email
         try:
-            from services.email_service import EmailService
-            EmailService.send_booking_confirmation(booking)
-            flash(f'Successfully booked Seat {seat.number} for {booking_date} at {booking_time.strftime("%I:%M %p")}. Confirmation email sent!', 'success')
-        except Exception as e:
-            print(f"Email error: {e}")
-            flash(f'Successfully booked Seat {seat.number} for {booking_date} at {booking_time.strftime("%I:%M %p")}', 'success')
+            # Flush first so the booking's relationships resolve for the email
+            db.session.flush()
+            # The confirmation is queued in the same transaction and sent by
+            # the background outbox sender, so SMTP never blocks this request
+            from services.booking_rollup import BookingRollupService
+            queue_booking_email(booking, 'confirmation')
+            BookingRollupService.booking_added(library.id, booking_date, booking_time)
+            db.session.commit()
+        except IntegrityError as e:
+            db.session.rollback()
+            if is_user_slot_conflict(e):
+                flash(USER_SLOT_TAKEN_MESSAGE, 'error')
+            else:
+                # Booked from another worker since our grid was built
+                AvailabilityService.invalidate(library.id, booking_date)
+                flash(SEAT_TAKEN_MESSAGE, 'error')
+            return redirect(url_for('seats', slug=slug, date=booking_date_str, time_slot=time_slot_str))
+        
+        AvailabilityService.mark_booked(library.id, booking_date, seat_id, booking_time)
+        NoShowExpiryWheel.schedule(booking)
+        AnalyticsCache.invalidate()
+        CheckinHub.booking_created(
+            library.id, booking.id, booking_date, current_user.username,
+            seat_number, booking_time, booking.grace_period_minutes
+        )
+        
+        flash(f'Successfully booked Seat {seat_number} for {booking_date} at {booking_time.strftime("%I:%M %p")}. A confirmation will be emailed to you.', 'success')
         
         return redirect(url_for('my_bookings', slug=slug))
     
@@ -678,8 +736,11 @@ def create_app(config_name='development'):
         """User's bookings for this library"""
         library = g.current_library
         
-        # Get all bookings for this user and library
-        bookings = Booking.query.filter_by(
+        # Get all bookings for this user and library, with their seats in
+        # the same query (the page and the check-in tokens need the number)
+        bookings = Booking.query.options(
+            joinedload(Booking.seat)
+        ).filter_by(
             user_id=current_user.id,
             library_id=library.id
         ).order_by(Booking.date.desc(), Booking.time_slot.desc()).all()
@@ -694,12 +755,33 @@ def create_app(config_name='development'):
             else:
                 past_bookings.append(booking)
         
+        from services.checkin_token import CheckinTokenService
+        checkin_tokens = {
+            booking.id: CheckinTokenService.issue_for_booking(booking)
+            for booking in upcoming_bookings
+        }
+        
         return render_template(
             'my_bookings.html',
             upcoming_bookings=upcoming_bookings,
-            past_bookings=past_bookings
+            past_bookings=past_bookings,
+            checkin_tokens=checkin_tokens
         )
     
+    @app.route('/checkin/qr/<token>.png')
+    def checkin_qr(token):
+        """QR code image for a check-in token (linked from emails and My Bookings)"""
+        from services.checkin_token import CheckinTokenService
+        
+        claims, error = CheckinTokenService.verify(token)
+        if error:
+            abort(404)
+        
+        response = app.response_class(CheckinTokenService.qr_png(token), mimetype='image/png')
+        # The image for a token never changes
+        response.headers['Cache-Control'] = 'public, max-age=86400, immutable'
+        return response
+    
     @app.route('/bookings/<int:booking_id>/cancel', methods=['POST'])
     @login_required
     def cancel_booking(booking_id):
@@ -721,18 +803,20 @@ def create_app(config_name='development'):
             flash('Cannot cancel past bookings', 'error')
             return redirect(url_for('my_bookings', slug=booking.library.slug))
         
-        # Send cancellation email before cancelling
-        try:
-            from services.email_service import EmailService
-            EmailService.send_cancellation_email(booking)
-        except Exception as e:
-            print(f"Email error: {e}")
-        
-        # Cancel booking
+        # Cancel booking; the email is queued in the same transaction
+        from services.booking_rollup import BookingRollupService
         booking.status = BookingStatus.cancelled
+        queue_booking_email(booking, 'cancellation')
+        BookingRollupService.status_changed(booking, BookingStatus.booked)
         db.session.commit()
         
-        flash(f'Booking for Seat {booking.seat.number} on {booking.date} has been cancelled. Confirmation email sent.', 'success')
+        from services.availability_service import AvailabilityService
+        AvailabilityService.release_booking(booking)
+        NoShowExpiryWheel.discard(booking.id)
+        CheckinHub.bookings_cancelled(booking.library_id, [booking.id])
+        AnalyticsCache.invalidate()
+        
+        flash(f'Booking for Seat {booking.seat.number} on {booking.date} has been cancelled. A confirmation will be emailed to you.', 'success')
         return redirect(url_for('my_bookings', slug=booking.library.slug))
     
     # ============= Public Library Routes =============
@@ -751,7 +835,8 @@ def create_app(config_name='development'):
         maintenance_seats = Seat.query.filter_by(library_id=library.id, in_maintenance=True).count()
         
         # Get system settings
-        settings = SystemSettings.query.filter_by(library_id=library.id).first()
+        schedule = SettingsRegistry.get(library.id)
+        settings = schedule.settings if schedule else None
         
         # Check if library has its own logo
         library_logo_url = f'/{library.logo_path}' if library.logo_path else None
@@ -807,40 +892,6 @@ def create_app(config_name='development'):
             selected_library=library_id
         )
     
-    # ============= AUTO-CANCELLATION SCHEDULER =============
-    
-    # Setup background scheduler for auto-cancellation
-    from apscheduler.schedulers.background import BackgroundScheduler
-    
-    scheduler = BackgroundScheduler()
-    
-    def auto_cancel_no_shows():
-        """Background job to auto-cancel bookings where users didn't report"""
-        with app.app_context():
-            try:
-                from services.reporting_service import ReportingService
-                count = ReportingService.auto_cancel_expired_bookings()
-                if count > 0:
-                    print(f"🔄 Auto-cancelled {count} no-show booking(s)")
-            except Exception as e:
-                print(f"⚠️ Auto-cancel error: {e}")
-    
-    # Schedule to run every 5 minutes
-    scheduler.add_job(
-        func=auto_cancel_no_shows,
-        trigger="interval",
-        minutes=5,
-        id='auto_cancel_job',
-        replace_existing=True
-    )
-    
-    scheduler.start()
-    print("✓ Auto-cancellation scheduler started (runs every 5 minutes)")
-    
-    # Shutdown scheduler on app exit
-    import atexit
-    atexit.register(lambda: scheduler.shutdown())
-    
     return app
 
 if __name__ == '__main__':
@@ -857,5 +908,7 @@ if __name__ == '__main__':
     print("   Student: student1 | password123")
     print("\n🌐 CSR Admin Panel:")
     print("   http://localhost:5000/csr-admin")
+    print("\n⏱  Background jobs (emails, reminders, no-show expiry):")
+    print("   run 'python worker.py' in another terminal")
     print("="*60 + "\n")
     app.run(debug=True, host='0.0.0.0', port=5000, use_reloader=False)
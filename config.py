@@ -55,6 +55,12 @@ class Config:
     SITE_NAME = 'Kaluwala CSR Libraries'
     SITE_URL = os.environ.get('SITE_URL', 'http://localhost:5000')
     
+    # Live reporting desk: every open Server-Sent Events stream holds one
+    # gunicorn thread, so at most a quarter of each worker's WEB_THREADS
+    # stream; other desks poll instead
+    WEB_THREADS = int(os.environ.get('WEB_THREADS', 4))
+    CHECKIN_MAX_STREAMS = int(os.environ.get('CHECKIN_MAX_STREAMS', max(1, WEB_THREADS // 4)))
+    
     # Session Configuration
     SESSION_COOKIE_SECURE = os.environ.get('SESSION_COOKIE_SECURE', 'False').lower() == 'true'
 
@@ -5,10 +5,16 @@ Network-wide administration for CSR Super Admins only
 
 from functools import wraps
 from datetime import datetime, date, time
-from flask import Blueprint, render_template, request, redirect, url_for, flash, jsonify
+from flask import Blueprint, render_template, request, redirect, url_for, flash, current_app
 from flask_login import login_required, current_user
 from models import db, Library, Seat, SystemSettings, Booking, User, LibraryAdmin, AdminRole, SeatCategory, BookingStatus, GalleryImage, GalleryStatus
 from services.analytics import AnalyticsService
+from services.availability_service import AvailabilityService
+from services.library_cache import LibraryCache
+from services.user_session import UserSessionService
+from services.settings_registry import SettingsRegistry
+from services.booking_rollup import BookingRollupService
+from services.analytics_cache import AnalyticsCache
 
 csr_admin_bp = Blueprint('csr_admin', __name__, url_prefix='/csr-admin')
 
@@ -27,33 +33,24 @@ def csr_super_admin_required(f):
 @csr_super_admin_required
 def dashboard():
     """CSR Super Admin dashboard with network-wide analytics"""
+    # All figures are cached until bookings change (see AnalyticsCache)
     # Get network summary
-    summary = AnalyticsService.get_network_summary()
+    summary = AnalyticsCache.get(AnalyticsService.get_network_summary)
     
-    # Get library utilization data
-    utilization_raw = AnalyticsService.get_library_utilization(days=30)
-    
-    # Enhance utilization data with library details
-    utilization = []
-    for util in utilization_raw:
-        library = Library.query.get(util['library_id'])
-        util['city'] = library.city if library else 'N/A'
-        util['state'] = library.state if library else 'N/A'
-        utilization.append(util)
+    # Get library utilization data (includes city and state)
+    utilization = AnalyticsCache.get(AnalyticsService.get_library_utilization, days=30)
     
     # Get daily booking trends
-    daily_trends = AnalyticsService.get_daily_bookings(days=30)
+    daily_trends = AnalyticsCache.get(AnalyticsService.get_daily_bookings, days=30)
     
     # Get library rankings
-    top_libraries = AnalyticsService.get_library_rankings(metric='bookings', days=30)
+    top_libraries = AnalyticsCache.get(AnalyticsService.get_library_rankings, metric='bookings', days=30)
     
     # Get user statistics
-    user_stats = AnalyticsService.get_user_statistics()
+    user_stats = AnalyticsCache.get(AnalyticsService.get_user_statistics)
     
     # Get pending gallery count
-    pending_gallery_count = GalleryImage.query.filter_by(
-        status=GalleryStatus.pending
-    ).count()
+    pending_gallery_count = AnalyticsCache.get(AnalyticsService.get_pending_gallery_count)
     
     return render_template(
         'csr_dashboard.html',
@@ -219,6 +216,8 @@ def create_library():
                     db.session.add(admin_assignment)
             
             db.session.commit()
+            LibraryCache.invalidate()
+            AnalyticsCache.invalidate()
             
             flash(f'Library "{name}" created successfully with {num_seats} seats!', 'success')
             return redirect(url_for('csr_admin.manage_libraries'))
@@ -247,6 +246,7 @@ def edit_library(library_id):
         library.csr_partner = request.form.get('csr_partner', '').strip()
         
         db.session.commit()
+        LibraryCache.invalidate()
         flash(f'Library "{library.name}" updated successfully', 'success')
         return redirect(url_for('csr_admin.manage_libraries'))
     
@@ -259,9 +259,16 @@ def delete_library(library_id):
     library = Library.query.get_or_404(library_id)
     
     library_name = library.name
+    BookingRollupService.library_deleted(library.id)
     db.session.delete(library)
     db.session.commit()
     
+    LibraryCache.invalidate()
+    AnalyticsCache.invalidate()
+    SettingsRegistry.invalidate(library_id)
+    AvailabilityService.invalidate_roster(library_id)
+    AvailabilityService.invalidate(library_id)
+    
     flash(f'Library "{library_name}" has been deleted', 'success')
     return redirect(url_for('csr_admin.manage_libraries'))
 
@@ -278,9 +285,7 @@ def update_seats(library_id):
         return redirect(url_for('csr_admin.manage_libraries'))
     
     # Get current seat count
-    current_seats = Seat.query.filter_by(library_id=library_id).order_by(
-        Seat.number.cast(db.Integer)
-    ).all()
+    current_seats = Seat.query.filter_by(library_id=library_id).order_by(Seat.sort_key).all()
     current_count = len(current_seats)
     
     try:
@@ -301,6 +306,8 @@ def update_seats(library_id):
                 db.session.add(new_seat)
             
             db.session.commit()
+            AvailabilityService.invalidate_roster(library_id)
+            AnalyticsCache.invalidate()
             flash(f'Added {seats_to_add} seats to {library.name}. Total: {new_total}', 'success')
         
         elif new_total < current_count:
@@ -319,11 +326,14 @@ def update_seats(library_id):
                     flash(f'Cannot remove seats with active bookings. Seat {seat.number} has {active_bookings} active booking(s).', 'error')
                     return redirect(url_for('csr_admin.manage_libraries'))
             
-            # Safe to delete
+            # Safe to delete (past bookings go with their seats)
+            BookingRollupService.seats_deleted([seat.id for seat in seats_to_delete])
             for seat in seats_to_delete:
                 db.session.delete(seat)
             
             db.session.commit()
+            AvailabilityService.invalidate_roster(library_id)
+            AnalyticsCache.invalidate()
             flash(f'Removed {seats_to_remove} seats from {library.name}. Total: {new_total}', 'success')
         
         else:
@@ -361,7 +371,7 @@ def update_reservations(library_id):
         general_seats = Seat.query.filter_by(
             library_id=library_id,
             category=SeatCategory.general
-        ).order_by(Seat.number.cast(db.Integer)).all()
+        ).order_by(Seat.sort_key).all()
         
         # Get current reserved seats
         current_researcher = Seat.query.filter_by(
@@ -391,7 +401,7 @@ def update_reservations(library_id):
         available_general = Seat.query.filter_by(
             library_id=library_id,
             category=SeatCategory.general
-        ).order_by(Seat.number.cast(db.Integer)).all()
+        ).order_by(Seat.sort_key).all()
         
         if len(available_general) < (researcher_count + staff_count):
             flash('Not enough available seats to allocate reservations. Some seats have active bookings.', 'error')
@@ -416,6 +426,7 @@ def update_reservations(library_id):
             staff_allocated += 1
         
         db.session.commit()
+        AvailabilityService.invalidate_roster(library_id)
         
         flash(f'Seat reservations updated: {researcher_count} for researchers, {staff_count} for staff', 'success')
     
@@ -476,6 +487,7 @@ def assign_admin():
     )
     
     db.session.add(assignment)
+    UserSessionService.invalidate(user_id)
     db.session.commit()
     
     user = User.query.get(user_id)
@@ -497,6 +509,7 @@ def remove_admin(user_id, library_id):
     library = Library.query.get(library_id)
     
     db.session.delete(assignment)
+    UserSessionService.invalidate(user_id)
     db.session.commit()
     
     flash(f'{user.username} removed from {library.name}', 'success')
@@ -509,14 +522,14 @@ def analytics():
     days = request.args.get('days', 30, type=int)
     
     # Get network summary
-    summary = AnalyticsService.get_network_summary()
+    summary = AnalyticsCache.get(AnalyticsService.get_network_summary)
     
-    # Get comprehensive analytics
-    utilization = AnalyticsService.get_library_utilization(days=days) or []
-    daily_trends = AnalyticsService.get_daily_bookings(days=days) or []
-    monthly_data = AnalyticsService.get_monthly_bookings(months=6) or []
-    peak_hours = AnalyticsService.get_peak_hours(days=days) or []
-    status_breakdown = AnalyticsService.get_booking_status_breakdown() or []
+    # Get comprehensive analytics (cached until bookings change)
+    utilization = AnalyticsCache.get(AnalyticsService.get_library_utilization, days=days) or []
+    daily_trends = AnalyticsCache.get(AnalyticsService.get_daily_bookings, days=days) or []
+    monthly_data = AnalyticsCache.get(AnalyticsService.get_monthly_bookings, months=6) or []
+    peak_hours = AnalyticsCache.get(AnalyticsService.get_peak_hours, days=days) or []
+    status_breakdown = AnalyticsCache.get(AnalyticsService.get_booking_status_breakdown) or []
     
     # Get rankings (just pass utilization data sorted by bookings)
     rankings = sorted(utilization, key=lambda x: x.get('total_bookings', 0), reverse=True)[:10] if utilization else []
@@ -550,16 +563,16 @@ def export_libraries():
 def api_utilization():
     """API endpoint for utilization data"""
     days = request.args.get('days', 30, type=int)
-    data = AnalyticsService.get_library_utilization(days=days)
-    return jsonify(data)
+    body = AnalyticsCache.get_json(AnalyticsService.get_library_utilization, days=days)
+    return current_app.response_class(body, mimetype='application/json')
 
 @csr_admin_bp.route('/api/daily-trends')
 @csr_super_admin_required
 def api_daily_trends():
     """API endpoint for daily booking trends"""
     days = request.args.get('days', 30, type=int)
-    data = AnalyticsService.get_daily_bookings(days=days)
-    return jsonify(data)
+    body = AnalyticsCache.get_json(AnalyticsService.get_daily_bookings, days=days)
+    return current_app.response_class(body, mimetype='application/json')
 
 @csr_admin_bp.route('/gallery/pending')
 @csr_super_admin_required
@@ -594,5 +607,6 @@ def approve_gallery_image():
         flash(f'Photo "{image.caption}" rejected', 'info')
     
     db.session.commit()
+    AnalyticsCache.invalidate()
     return redirect(url_for('csr_admin.gallery_approvals'))
 
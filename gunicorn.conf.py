@@ -19,7 +19,8 @@ timeout = 120
 keepalive = 2
 
 # Threads per worker (handles concurrent requests efficiently)
-threads = 4
+# (config.py reads the same variable to size the live reporting desk)
+threads = int(os.environ.get('WEB_THREADS', 4))
 
 # Logging
 accesslog = "-"  # Log to stdout
@@ -4,12 +4,23 @@ Creates initial data for Kaluwala CSR Libraries Network
 Includes BPSMV Central Library setup with official logo
 """
 
+import argparse
 import os
 import sys
-from datetime import time
+from datetime import date, datetime, time
 from flask import Flask
 from config import config
-from models import db, User, Library, Seat, SystemSettings, LibraryAdmin, SeatCategory, AdminRole
+from sqlalchemy import and_, inspect, text
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import aliased
+from models import db, User, Library, Seat, SystemSettings, LibraryAdmin, SeatCategory, AdminRole, seat_sort_key
+from models import Booking, BookingRollup, BookingStatus, BOOKING_SEAT_SLOT_INDEX, BOOKING_USER_SLOT_INDEX
+
+# First key of the two-key PostgreSQL advisory lock taken by schema upgrades;
+# the second identifies the upgrade
+SCHEMA_LOCK_CLASS = 0x736368
+SCHEMA_LOCK_ACTIVE_INDEXES = 1
+SCHEMA_LOCK_BOOKING_ROLLUP = 2
 
 def create_app():
     """Create Flask app for migration"""
@@ -170,6 +181,218 @@ def create_admin_user(library):
     
     return admin
 
+def upgrade_seat_sort_keys():
+    """Add and backfill seat.sort_key on databases created before it existed"""
+    columns = {column['name'] for column in inspect(db.engine).get_columns('seat')}
+    if 'sort_key' not in columns:
+        print("\n🔧 Adding seat.sort_key column...")
+        db.session.execute(text('ALTER TABLE seat ADD COLUMN sort_key VARCHAR(100)'))
+        db.session.commit()
+    
+    indexes = {index['name'] for index in inspect(db.engine).get_indexes('seat')}
+    if 'idx_seat_library_sort' not in indexes:
+        db.session.execute(text('CREATE INDEX idx_seat_library_sort ON seat (library_id, sort_key)'))
+        db.session.commit()
+    
+    # Backfill rows written before the column existed
+    missing = db.session.query(Seat.id, Seat.number).filter(Seat.sort_key.is_(None)).all()
+    if missing:
+        db.session.bulk_update_mappings(Seat, [
+            {'id': seat_id, 'sort_key': seat_sort_key(number)}
+            for seat_id, number in missing
+        ])
+        db.session.commit()
+        print(f"✓ Backfilled sort keys for {len(missing)} seats")
+
+def _lock_upgrade(key):
+    """
+    On PostgreSQL, hold an advisory lock until the current transaction ends,
+    so web and worker processes starting together apply an upgrade once
+    """
+    if db.engine.dialect.name == 'postgresql':
+        db.session.execute(
+            text('SELECT pg_advisory_xact_lock(:cls, :key)'),
+            {'cls': SCHEMA_LOCK_CLASS, 'key': key}
+        )
+
+# Partial unique indexes on active bookings: name -> (columns, description)
+ACTIVE_BOOKING_INDEXES = {
+    BOOKING_SEAT_SLOT_INDEX: (('seat_id', 'date', 'time_slot'), 'same seat and slot'),
+    BOOKING_USER_SLOT_INDEX: (('user_id', 'library_id', 'date', 'time_slot'), 'same user and slot'),
+}
+
+def _duplicate_active_booking_ids(columns):
+    """
+    IDs of active bookings that share the given columns with an earlier
+    active booking, i.e. everything but the first of each duplicate group
+    """
+    earlier = aliased(Booking)
+    return sorted(row.id for row in db.session.query(Booking.id).join(
+        earlier, and_(
+            earlier.id < Booking.id,
+            earlier.status == BookingStatus.booked,
+            *[getattr(earlier, column) == getattr(Booking, column) for column in columns]
+        )
+    ).filter(
+        Booking.status == BookingStatus.booked
+    ).distinct())
+
+def upgrade_booking_active_indexes():
+    """Replace the all-status booking unique constraint with partial indexes on active bookings"""
+    _lock_upgrade(SCHEMA_LOCK_ACTIVE_INDEXES)
+    inspector = inspect(db.session.connection())
+    indexes = {index['name'] for index in inspector.get_indexes('booking')}
+    for name, (columns, label) in ACTIVE_BOOKING_INDEXES.items():
+        if name in indexes:
+            continue
+        # Never change bookings at startup; an operator resolves duplicates
+        duplicate_ids = _duplicate_active_booking_ids(columns)
+        if duplicate_ids:
+            print(f"⚠️  Not creating index {name}: {len(duplicate_ids)} active bookings "
+                  f"duplicate an earlier one ({label}): {duplicate_ids}")
+            print("   Run 'python migrate.py --cancel-duplicate-bookings' to cancel them")
+            continue
+        print(f"\n🔧 Creating index {name}...")
+        db.session.execute(text(
+            f"CREATE UNIQUE INDEX IF NOT EXISTS {name} "
+            f"ON booking ({', '.join(columns)}) WHERE status = 'booked'"
+        ))
+    
+    constraints = {
+        constraint['name']
+        for constraint in inspector.get_unique_constraints('booking')
+    }
+    if 'unique_booking_per_slot' in constraints:
+        if db.engine.dialect.name == 'postgresql':
+            print("\n🔧 Dropping legacy unique_booking_per_slot constraint...")
+            db.session.execute(text('ALTER TABLE booking DROP CONSTRAINT unique_booking_per_slot'))
+        else:
+            # SQLite cannot drop a table constraint without rebuilding the table
+            print("⚠️  booking.unique_booking_per_slot still present; "
+                  "cancelled slots cannot be rebooked until the table is rebuilt")
+    # One commit for the whole upgrade, which also releases the lock
+    db.session.commit()
+
+def upgrade_booking_reminder_column():
+    """Add booking.reminder_sent_at on databases created before reminders existed"""
+    columns = {column['name'] for column in inspect(db.engine).get_columns('booking')}
+    if 'reminder_sent_at' not in columns:
+        print("\n🔧 Adding booking.reminder_sent_at column...")
+        db.session.execute(text('ALTER TABLE booking ADD COLUMN reminder_sent_at TIMESTAMP'))
+        db.session.commit()
+
+def upgrade_user_session_version():
+    """Add user.session_version on databases created before it existed"""
+    columns = {column['name'] for column in inspect(db.engine).get_columns('user')}
+    if 'session_version' not in columns:
+        print("\n🔧 Adding user.session_version column...")
+        db.session.execute(text(
+            'ALTER TABLE "user" ADD COLUMN session_version INTEGER NOT NULL DEFAULT 0'
+        ))
+        db.session.commit()
+
+def upgrade_booking_desk_index():
+    """Add the (library_id, date, time_slot) index used by the reporting desk"""
+    indexes = {index['name'] for index in inspect(db.engine).get_indexes('booking')}
+    if 'idx_booking_library_date_slot' not in indexes:
+        print("\n🔧 Creating index idx_booking_library_date_slot...")
+        db.session.execute(text(
+            'CREATE INDEX idx_booking_library_date_slot ON booking (library_id, date, time_slot)'
+        ))
+        db.session.commit()
+
+def upgrade_booking_rollup():
+    """
+    Bring the analytics rollup to the current key and fill it on databases
+    that had bookings before it existed
+    """
+    from services.booking_rollup import BookingRollupService
+    
+    # Early rollups were also keyed by seat category, which a seat can
+    # change after it was booked; recreate the table without it
+    _lock_upgrade(SCHEMA_LOCK_BOOKING_ROLLUP)
+    columns = {
+        column['name']
+        for column in inspect(db.session.connection()).get_columns('booking_rollup')
+    }
+    if 'seat_category' in columns:
+        print("\n🔧 Recreating booking_rollup without seat_category...")
+        BookingRollup.__table__.drop(db.session.connection())
+        BookingRollup.__table__.create(db.session.connection())
+    db.session.commit()
+    
+    # Check under the lock, so of several processes starting together only
+    # the first one rebuilds
+    BookingRollupService.lock()
+    if db.session.query(BookingRollup.library_id).first() is None and \
+            db.session.query(Booking.id).first() is not None:
+        print("\n🔧 Building booking_rollup from booking history...")
+        try:
+            rows = BookingRollupService.rebuild()
+        except IntegrityError:
+            # Without table locks (SQLite) another process may have filled it first
+            db.session.rollback()
+            print("⚠️  booking_rollup was filled concurrently; skipped rebuild")
+            return
+        print(f"✓ Wrote {rows} rollup rows")
+    else:
+        db.session.commit()
+
+def run_schema_upgrades():
+    """Apply in-place schema upgrades that db.create_all() cannot make"""
+    upgrade_seat_sort_keys()
+    # Before any upgrade that moves bookings between rollup buckets
+    upgrade_booking_rollup()
+    upgrade_booking_active_indexes()
+    upgrade_booking_reminder_column()
+    upgrade_booking_desk_index()
+    upgrade_user_session_version()
+
+def cancel_duplicate_bookings():
+    """
+    Operator step: cancel all but the earliest of each group of duplicate
+    active bookings, email the affected users about upcoming ones, then
+    build the unique indexes the duplicates were blocking
+    """
+    from services.booking_rollup import BookingRollupService
+    from services.email_service import EmailService
+    
+    cancelled_ids = []
+    for name, (columns, label) in ACTIVE_BOOKING_INDEXES.items():
+        duplicate_ids = _duplicate_active_booking_ids(columns)
+        if not duplicate_ids:
+            continue
+        ids = db.session.execute(
+            db.update(Booking).where(
+                Booking.id.in_(duplicate_ids),
+                Booking.status == BookingStatus.booked
+            ).values(
+                status=BookingStatus.cancelled,
+                cancellation_reason='Duplicate booking for the same slot',
+                updated_at=datetime.utcnow()
+            ).returning(Booking.id)
+        ).scalars().all()
+        print(f"✓ Cancelled {len(ids)} duplicate bookings ({label}): {sorted(ids)}")
+        cancelled_ids.extend(ids)
+    
+    if not cancelled_ids:
+        print("✓ No duplicate active bookings")
+    else:
+        rows = EmailService.booking_rows_query().filter(
+            Booking.id.in_(cancelled_ids),
+            Booking.date >= date.today()
+        ).all()
+        EmailService.queue_booking_emails('cancellation', rows)
+        print(f"✓ Queued {len(rows)} cancellation emails for upcoming bookings")
+        # An empty rollup is rebuilt from scratch by upgrade_booking_rollup()
+        if db.session.query(BookingRollup.library_id).first() is not None:
+            BookingRollupService.bookings_transitioned(
+                cancelled_ids, BookingStatus.booked, BookingStatus.cancelled
+            )
+        db.session.commit()
+    
+    upgrade_booking_active_indexes()
+
 def run_migration():
     """Run the complete migration"""
     print("="*70)
@@ -183,6 +406,7 @@ def run_migration():
         # Create all tables
         print("\n📊 Creating database tables...")
         db.create_all()
+        run_schema_upgrades()
         print("✓ Database tables ready")
         
         # Create BPSMV library
@@ -232,8 +456,18 @@ def run_migration():
         print("="*70 + "\n")
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Create or upgrade the database')
+    parser.add_argument(
+        '--cancel-duplicate-bookings', action='store_true',
+        help='cancel duplicate active bookings that block the unique booking indexes'
+    )
+    args = parser.parse_args()
     try:
-        run_migration()
+        if args.cancel_duplicate_bookings:
+            with create_app().app_context():
+                cancel_duplicate_bookings()
+        else:
+            run_migration()
     except Exception as e:
         print(f"\n❌ Migration failed: {str(e)}")
         import traceback
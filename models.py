@@ -3,6 +3,8 @@ from flask_sqlalchemy import SQLAlchemy
 from flask_login import UserMixin
 from werkzeug.security import generate_password_hash, check_password_hash
 import enum
+import re
+from sqlalchemy.orm import validates
 
 db = SQLAlchemy()
 
@@ -33,6 +35,17 @@ class UserRole(enum.Enum):
     staff = 'staff'             # Staff - can book staff seats
     library_admin = 'library_admin'  # Library administrator
 
+class OutboxStatus(enum.Enum):
+    pending = 'pending'
+    sent = 'sent'
+    failed = 'failed'      # Gave up after the maximum number of attempts
+
+class JobStatus(enum.Enum):
+    pending = 'pending'    # Waiting for run_at
+    running = 'running'
+    done = 'done'          # One-off job finished
+    failed = 'failed'      # One-off job gave up
+
 class GalleryStatus(enum.Enum):
     pending = 'pending'
     approved = 'approved'
@@ -72,6 +85,10 @@ class User(UserMixin, db.Model):
     home_library_id = db.Column(db.Integer, db.ForeignKey('library.id'), nullable=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     
+    # Bumped whenever access changes; cached session snapshots of an older
+    # version are discarded by every process
+    session_version = db.Column(db.Integer, default=0, server_default='0', nullable=False)
+    
     # Relationships
     bookings = db.relationship('Booking', foreign_keys='Booking.user_id', back_populates='user', lazy='dynamic', cascade='all, delete-orphan')
     library_assignments = db.relationship('LibraryAdmin', back_populates='user', cascade='all, delete-orphan')
@@ -89,18 +106,29 @@ class User(UserMixin, db.Model):
         """Return user ID as string for Flask-Login"""
         return str(self.id)
     
+    def get_permission_map(self):
+        """
+        Map of library_id -> AdminRole for this user's assignments.
+        Loaded with one query the first time it is needed and kept on the
+        instance, so repeated permission checks in a request are free.
+        Users restored from the session snapshot arrive with it pre-filled.
+        """
+        permission_map = getattr(self, '_permission_map', None)
+        if permission_map is None:
+            rows = db.session.query(LibraryAdmin.library_id, LibraryAdmin.role).filter(
+                LibraryAdmin.user_id == self.id
+            ).all()
+            permission_map = {library_id: role for library_id, role in rows}
+            self._permission_map = permission_map
+        return permission_map
+    
     def is_admin_of(self, library_id):
         """Check if user is admin of a specific library"""
         # CSR Super Admins have admin access to all libraries
         if self.is_csr_super_admin:
             return True
         
-        assignment = LibraryAdmin.query.filter_by(
-            user_id=self.id, 
-            library_id=library_id,
-            role=AdminRole.admin
-        ).first()
-        return assignment is not None
+        return self.get_permission_map().get(library_id) == AdminRole.admin
     
     def is_staff_of(self, library_id):
         """Check if user is staff or admin of a specific library"""
@@ -108,11 +136,7 @@ class User(UserMixin, db.Model):
         if self.is_csr_super_admin:
             return True
         
-        assignment = LibraryAdmin.query.filter_by(
-            user_id=self.id, 
-            library_id=library_id
-        ).first()
-        return assignment is not None
+        return library_id in self.get_permission_map()
     
     def get_accessible_libraries(self):
         """Get all libraries the user has access to"""
@@ -120,8 +144,10 @@ class User(UserMixin, db.Model):
         if self.is_csr_super_admin:
             return Library.query.all()
         
-        assignments = LibraryAdmin.query.filter_by(user_id=self.id).all()
-        return [assignment.library for assignment in assignments]
+        library_ids = list(self.get_permission_map())
+        if not library_ids:
+            return []
+        return Library.query.filter(Library.id.in_(library_ids)).all()
     
     def __repr__(self):
         return f'<User {self.username}>'
@@ -164,12 +190,25 @@ class Library(db.Model):
     def __repr__(self):
         return f'<Library {self.name}>'
 
+# Seat numbers are labels like "12" or "A-12"; digit runs are zero-padded so
+# that a plain string ORDER BY gives natural order ("A-2" before "A-10").
+SEAT_SORT_DIGITS = 8
+
+def seat_sort_key(number):
+    """Natural-order sort key for a seat number"""
+    return re.sub(
+        r'\d+',
+        lambda m: m.group(0).zfill(SEAT_SORT_DIGITS),
+        str(number).strip().upper()
+    )
+
 class Seat(db.Model):
     __tablename__ = 'seat'
     
     id = db.Column(db.Integer, primary_key=True)
     library_id = db.Column(db.Integer, db.ForeignKey('library.id'), nullable=False, index=True)
     number = db.Column(db.String(20), nullable=False)
+    sort_key = db.Column(db.String(100), nullable=True)  # Maintained from number, see seat_sort_key()
     category = db.Column(db.Enum(SeatCategory), nullable=False, default=SeatCategory.general)
     in_maintenance = db.Column(db.Boolean, default=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
@@ -181,11 +220,21 @@ class Seat(db.Model):
     # Unique constraint: seat number must be unique within a library
     __table_args__ = (
         db.UniqueConstraint('library_id', 'number', name='unique_seat_per_library'),
+        db.Index('idx_seat_library_sort', 'library_id', 'sort_key'),
     )
     
+    @validates('number')
+    def _update_sort_key(self, key, number):
+        """Keep sort_key in step with number on every create/rename"""
+        self.sort_key = seat_sort_key(number)
+        return number
+    
     def __repr__(self):
         return f'<Seat {self.number} at Library {self.library_id}>'
 
+BOOKING_SEAT_SLOT_INDEX = 'uq_booking_active_seat_slot'
+BOOKING_USER_SLOT_INDEX = 'uq_booking_active_user_slot'
+
 class Booking(db.Model):
     __tablename__ = 'booking'
     
@@ -210,16 +259,34 @@ class Booking(db.Model):
     cancellation_reason = db.Column(db.String(200), nullable=True)
     grace_period_minutes = db.Column(db.Integer, default=15, nullable=False)
     
+    # Set when the day-before reminder has been queued
+    reminder_sent_at = db.Column(db.DateTime, nullable=True)
+    
     # Relationships
     library = db.relationship('Library', back_populates='bookings')
     user = db.relationship('User', foreign_keys=[user_id], back_populates='bookings')
     seat = db.relationship('Seat', back_populates='bookings')
     reporting_admin = db.relationship('User', foreign_keys=[reported_by_admin])
     
-    # Unique constraint: one booking per seat per date per time_slot
+    # Partial unique indexes: among *active* bookings, one per seat per slot
+    # and one per user per library slot. Cancelled rows are excluded so a
+    # freed slot can be booked again.
     __table_args__ = (
-        db.UniqueConstraint('seat_id', 'date', 'time_slot', name='unique_booking_per_slot'),
+        db.Index(
+            BOOKING_SEAT_SLOT_INDEX, 'seat_id', 'date', 'time_slot',
+            unique=True,
+            postgresql_where=db.text("status = 'booked'"),
+            sqlite_where=db.text("status = 'booked'")
+        ),
+        db.Index(
+            BOOKING_USER_SLOT_INDEX, 'user_id', 'library_id', 'date', 'time_slot',
+            unique=True,
+            postgresql_where=db.text("status = 'booked'"),
+            sqlite_where=db.text("status = 'booked'")
+        ),
         db.Index('idx_library_date', 'library_id', 'date'),
+        # Front-desk reporting: one day's bookings by slot time
+        db.Index('idx_booking_library_date_slot', 'library_id', 'date', 'time_slot'),
     )
     
     def is_grace_period_expired(self):
@@ -336,3 +403,101 @@ class NoShowHistory(db.Model):
     
     def __repr__(self):
         return f'<NoShow User:{self.user_id} Date:{self.booking_date}>'
+
+class EmailOutbox(db.Model):
+    """Outgoing email, written in the same transaction as the change it reports"""
+    __tablename__ = 'email_outbox'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    recipient = db.Column(db.String(120), nullable=False)
+    subject = db.Column(db.String(255), nullable=False)
+    html = db.Column(db.Text, nullable=False)
+    
+    status = db.Column(db.Enum(OutboxStatus), nullable=False, default=OutboxStatus.pending)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    next_attempt_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    last_error = db.Column(db.Text, nullable=True)
+    
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    sent_at = db.Column(db.DateTime, nullable=True)
+    
+    # The sender polls for due pending messages
+    __table_args__ = (
+        db.Index('idx_outbox_status_next', 'status', 'next_attempt_at'),
+    )
+    
+    def __repr__(self):
+        return f'<EmailOutbox {self.id}: {self.recipient} ({self.status.value})>'
+
+class BackgroundJob(db.Model):
+    """
+    A job for the background worker. Recurring jobs have interval_seconds
+    and are rescheduled after every run; one-off queued jobs run once.
+    """
+    __tablename__ = 'background_job'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(100), nullable=False, index=True)
+    payload = db.Column(db.Text, nullable=True)  # JSON keyword arguments
+    interval_seconds = db.Column(db.Integer, nullable=True)
+    
+    status = db.Column(db.Enum(JobStatus), nullable=False, default=JobStatus.pending)
+    run_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    
+    started_at = db.Column(db.DateTime, nullable=True)
+    finished_at = db.Column(db.DateTime, nullable=True)
+    last_duration_ms = db.Column(db.Integer, nullable=True)
+    last_error = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    # The worker polls for due pending jobs; each recurring job has one row
+    __table_args__ = (
+        db.Index('idx_job_status_run_at', 'status', 'run_at'),
+        db.Index(
+            'uq_job_recurring_name', 'name',
+            unique=True,
+            postgresql_where=db.text('interval_seconds IS NOT NULL'),
+            sqlite_where=db.text('interval_seconds IS NOT NULL')
+        ),
+    )
+    
+    def __repr__(self):
+        return f'<BackgroundJob {self.id}: {self.name} ({self.status.value})>'
+
+class JobRun(db.Model):
+    """One execution of a background job, kept for duration history"""
+    __tablename__ = 'job_run'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    job_id = db.Column(db.Integer, db.ForeignKey('background_job.id', ondelete='CASCADE'), nullable=False, index=True)
+    job_name = db.Column(db.String(100), nullable=False)
+    started_at = db.Column(db.DateTime, nullable=False)
+    duration_ms = db.Column(db.Integer, nullable=False)
+    succeeded = db.Column(db.Boolean, nullable=False)
+    error = db.Column(db.Text, nullable=True)
+    
+    def __repr__(self):
+        return f'<JobRun {self.job_name} {self.duration_ms}ms>'
+
+class BookingRollup(db.Model):
+    """
+    Booking counts per library, day, hour and status. Kept up to date in
+    the same transaction as every booking write so analytics never scan
+    the booking table.
+    """
+    __tablename__ = 'booking_rollup'
+    
+    library_id = db.Column(db.Integer, db.ForeignKey('library.id'), primary_key=True)
+    date = db.Column(db.Date, primary_key=True)
+    hour = db.Column(db.Integer, primary_key=True)  # Hour of the time slot, 0-23
+    status = db.Column(db.Enum(BookingStatus), primary_key=True)
+    count = db.Column(db.Integer, nullable=False, default=0)
+    
+    # Network-wide date-range queries (the primary key leads with library)
+    __table_args__ = (
+        db.Index('idx_rollup_date', 'date'),
+    )
+    
+    def __repr__(self):
+        return f'<BookingRollup {self.library_id} {self.date} {self.hour}h {self.status.value}: {self.count}>'
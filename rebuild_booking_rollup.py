@@ -0,0 +1,34 @@
+"""
+Rebuild Booking Rollup
+Recounts the analytics rollup table from the full booking history
+
+Usage: python rebuild_booking_rollup.py [--library SLUG]
+"""
+
+import argparse
+from app import create_app
+from models import Library
+from services.booking_rollup import BookingRollupService
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Rebuild the booking_rollup analytics table')
+    parser.add_argument('--library', metavar='SLUG', help='only rebuild this library')
+    args = parser.parse_args()
+
+    app = create_app()
+    with app.app_context():
+        library_id = None
+        if args.library:
+            library = Library.query.filter_by(slug=args.library).first()
+            if library is None:
+                parser.error(f"no library with slug '{args.library}'")
+            library_id = library.id
+
+        rows = BookingRollupService.rebuild(library_id)
+        scope = args.library or 'all libraries'
+        print(f'✓ Rebuilt booking rollup for {scope}: {rows} rows')
+
+
+if __name__ == '__main__':
+    main()
@@ -7,10 +7,34 @@ from .email_service import EmailService
 from .pdf_service import PDFReportService
 from .bulk_service import BulkOperationsService
 from .reporting_service import ReportingService
+from .availability_service import AvailabilityService
+from .library_cache import LibraryCache
+from .user_session import UserSessionService
+from .settings_registry import SettingsRegistry
+from .email_outbox import EmailOutboxService
+from .reminder_service import ReminderService
+from .expiry_wheel import NoShowExpiryWheel
+from .job_runner import JobRunner
+from .checkin_hub import CheckinHub
+from .checkin_token import CheckinTokenService
+from .booking_rollup import BookingRollupService
+from .analytics_cache import AnalyticsCache
 
 __all__ = [
     'EmailService',
     'PDFReportService', 
     'BulkOperationsService',
-    'ReportingService'
+    'ReportingService',
+    'AvailabilityService',
+    'LibraryCache',
+    'UserSessionService',
+    'SettingsRegistry',
+    'EmailOutboxService',
+    'ReminderService',
+    'NoShowExpiryWheel',
+    'JobRunner',
+    'CheckinHub',
+    'CheckinTokenService',
+    'BookingRollupService',
+    'AnalyticsCache'
 ]
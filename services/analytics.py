@@ -6,78 +6,124 @@ Provides network-wide metrics, library statistics, and data export capabilities
 import csv
 import io
 from datetime import datetime, date, timedelta
-from flask import make_response
-from models import db, Library, Seat, Booking, User, BookingStatus, SeatCategory, SystemSettings
+from flask import Response, make_response, stream_with_context
+from models import db, Library, Seat, Booking, BookingRollup, User, BookingStatus, SeatCategory, SystemSettings, GalleryImage, GalleryStatus
 from sqlalchemy import func, and_, or_, extract, cast, String
+from services.settings_registry import generate_time_slots
+
+# Rows fetched from the database cursor per chunk of a streamed export
+EXPORT_CHUNK_ROWS = 1000
 
 class AnalyticsService:
-    """Service class for analytics and reporting"""
+    """
+    Service class for analytics and reporting. Booking counts come from the
+    booking_rollup table (see BookingRollupService), so their cost does not
+    grow with booking history.
+    """
     
     @staticmethod
     def get_network_summary():
-        """Get overall network statistics"""
-        total_libraries = Library.query.count()
-        total_seats = Seat.query.count()
-        total_users = User.query.count()
-        total_bookings = Booking.query.count()
-        active_bookings = Booking.query.filter_by(status=BookingStatus.booked).filter(
-            Booking.date >= date.today()
-        ).count()
-        
-        return {
-            'total_libraries': total_libraries,
-            'total_seats': total_seats,
-            'total_users': total_users,
-            'total_bookings': total_bookings,
-            'active_bookings': active_bookings
-        }
+        """
+        Get overall network statistics in one statement of scalar
+        subqueries; booking counts come from the rollup
+        """
+        def count(model, *conditions):
+            return db.select(func.count()).select_from(model).where(*conditions).scalar_subquery()
+        
+        def rollup_sum(*conditions):
+            return db.select(
+                func.coalesce(func.sum(BookingRollup.count), 0)
+            ).where(*conditions).scalar_subquery()
+        
+        row = db.session.execute(db.select(
+            count(Library).label('total_libraries'),
+            count(Seat).label('total_seats'),
+            count(User).label('total_users'),
+            count(User, User.is_active == True).label('active_users'),
+            rollup_sum().label('total_bookings'),
+            rollup_sum(
+                BookingRollup.status == BookingStatus.booked,
+                BookingRollup.date >= date.today()
+            ).label('active_bookings')
+        )).one()
+        
+        return dict(row._mapping)
+    
+    @staticmethod
+    def get_public_summary():
+        """Library, seat and active user counts for the public home page, in one statement"""
+        def count(model, *conditions):
+            return db.select(func.count()).select_from(model).where(*conditions).scalar_subquery()
+        
+        row = db.session.execute(db.select(
+            count(Library).label('total_libraries'),
+            count(Seat).label('total_seats'),
+            count(User, User.is_active == True).label('active_users')
+        )).one()
+        
+        return dict(row._mapping)
     
     @staticmethod
     def get_library_utilization(library_id=None, days=30):
         """
         Calculate utilization percentage for libraries
         Utilization = (Total Bookings / (Total Seats * Days * Slots per Day)) * 100
+        
+        One grouped query returns every library with its settings, seat
+        count and booking count; libraries without settings are skipped.
         """
-        start_date = date.today() - timedelta(days=days)
+        today = date.today()
+        start_date = today - timedelta(days=days)
+        actual_days = (today - start_date).days + 1
+        
+        seat_counts = db.session.query(
+            Seat.library_id,
+            func.count(Seat.id).label('total_seats')
+        ).group_by(Seat.library_id).subquery()
+        
+        booking_counts = db.session.query(
+            BookingRollup.library_id,
+            func.sum(BookingRollup.count).label('total_bookings')
+        ).filter(
+            BookingRollup.date >= start_date,
+            BookingRollup.date <= today
+        ).group_by(BookingRollup.library_id).subquery()
+        
+        query = db.session.query(
+            Library.id, Library.name, Library.slug, Library.city, Library.state,
+            SystemSettings.opening_time, SystemSettings.closing_time, SystemSettings.slot_duration,
+            func.coalesce(seat_counts.c.total_seats, 0),
+            func.coalesce(booking_counts.c.total_bookings, 0)
+        ).join(
+            SystemSettings, SystemSettings.library_id == Library.id
+        ).outerjoin(
+            seat_counts, seat_counts.c.library_id == Library.id
+        ).outerjoin(
+            booking_counts, booking_counts.c.library_id == Library.id
+        )
         
         if library_id:
-            libraries = [Library.query.get(library_id)]
-        else:
-            libraries = Library.query.all()
+            query = query.filter(Library.id == library_id)
         
         utilization_data = []
         
-        for library in libraries:
-            # Get total seats
-            total_seats = Seat.query.filter_by(library_id=library.id).count()
-            
-            # Get system settings for slots calculation
-            settings = SystemSettings.query.filter_by(library_id=library.id).first()
-            if not settings:
-                continue
-            
-            # Calculate slots per day
-            hours = settings.closing_time.hour - settings.opening_time.hour
-            slots_per_day = (hours * 60) // settings.slot_duration
-            
-            # Get total bookings in period
-            total_bookings = Booking.query.filter(
-                Booking.library_id == library.id,
-                Booking.date >= start_date,
-                Booking.date <= date.today()
-            ).count()
+        for (lib_id, name, slug, city, state, opening_time, closing_time,
+             slot_duration, total_seats, total_bookings) in query.order_by(Library.id):
+            # Slots per day from the library's slot grid
+            slots_per_day = len(generate_time_slots(opening_time, closing_time, slot_duration))
             
             # Calculate maximum possible bookings
-            actual_days = (date.today() - start_date).days + 1
             max_bookings = total_seats * actual_days * slots_per_day
             
             # Calculate utilization percentage
             utilization = (total_bookings / max_bookings * 100) if max_bookings > 0 else 0
             
             utilization_data.append({
-                'library_id': library.id,
-                'library_name': library.name,
-                'library_slug': library.slug,
+                'library_id': lib_id,
+                'library_name': name,
+                'library_slug': slug,
+                'city': city,
+                'state': state,
                 'total_seats': total_seats,
                 'total_bookings': total_bookings,
                 'max_bookings': max_bookings,
@@ -93,17 +139,19 @@ class AnalyticsService:
         start_date = date.today() - timedelta(days=days)
         
         query = db.session.query(
-            Booking.date,
-            func.count(Booking.id).label('count')
+            BookingRollup.date,
+            func.sum(BookingRollup.count).label('count')
         ).filter(
-            Booking.date >= start_date,
-            Booking.date <= date.today()
+            BookingRollup.date >= start_date,
+            BookingRollup.date <= date.today()
         )
         
         if library_id:
-            query = query.filter(Booking.library_id == library_id)
+            query = query.filter(BookingRollup.library_id == library_id)
         
-        results = query.group_by(Booking.date).order_by(Booking.date).all()
+        results = query.group_by(BookingRollup.date).having(
+            func.sum(BookingRollup.count) > 0
+        ).order_by(BookingRollup.date).all()
         
         return [
             {
@@ -121,16 +169,18 @@ class AnalyticsService:
         # Use PostgreSQL to_char instead of SQLite strftime
         # Format: to_char(date_column, 'YYYY-MM')
         query = db.session.query(
-            func.to_char(Booking.date, 'YYYY-MM').label('month'),
-            func.count(Booking.id).label('count')
+            func.to_char(BookingRollup.date, 'YYYY-MM').label('month'),
+            func.sum(BookingRollup.count).label('count')
         ).filter(
-            Booking.date >= start_date
+            BookingRollup.date >= start_date
         )
         
         if library_id:
-            query = query.filter(Booking.library_id == library_id)
+            query = query.filter(BookingRollup.library_id == library_id)
         
-        results = query.group_by('month').order_by('month').all()
+        results = query.group_by('month').having(
+            func.sum(BookingRollup.count) > 0
+        ).order_by('month').all()
         
         return [
             {
@@ -147,14 +197,15 @@ class AnalyticsService:
         
         if metric == 'bookings':
             # Rank by total bookings
+            total = func.sum(BookingRollup.count)
             results = db.session.query(
                 Library.id,
                 Library.name,
                 Library.slug,
-                func.count(Booking.id).label('value')
-            ).join(Booking).filter(
-                Booking.date >= start_date
-            ).group_by(Library.id).order_by(func.count(Booking.id).desc()).all()
+                total.label('value')
+            ).join(BookingRollup, BookingRollup.library_id == Library.id).filter(
+                BookingRollup.date >= start_date
+            ).group_by(Library.id).having(total > 0).order_by(total.desc()).all()
         
         elif metric == 'users':
             # Rank by unique users
@@ -194,14 +245,16 @@ class AnalyticsService:
     def get_booking_status_breakdown(library_id=None):
         """Get breakdown of bookings by status"""
         query = db.session.query(
-            Booking.status,
-            func.count(Booking.id).label('count')
+            BookingRollup.status,
+            func.sum(BookingRollup.count).label('count')
         )
         
         if library_id:
-            query = query.filter(Booking.library_id == library_id)
+            query = query.filter(BookingRollup.library_id == library_id)
         
-        results = query.group_by(Booking.status).all()
+        results = query.group_by(BookingRollup.status).having(
+            func.sum(BookingRollup.count) > 0
+        ).all()
         
         return {
             status.value: count
@@ -210,48 +263,67 @@ class AnalyticsService:
     
     @staticmethod
     def export_bookings_csv(library_id=None, start_date=None, end_date=None):
-        """Export bookings data to CSV"""
-        query = Booking.query
+        """
+        Export bookings data to CSV, streamed. Rows come from one flat joined
+        query read through a server-side cursor in chunks of
+        EXPORT_CHUNK_ROWS, so memory use does not depend on the row count.
+        """
+        query = db.select(
+            Booking.id, Library.name, User.username, Seat.number,
+            Booking.date, Booking.time_slot, Booking.status, Booking.created_at
+        ).join(Library, Booking.library_id == Library.id
+        ).join(User, Booking.user_id == User.id
+        ).join(Seat, Booking.seat_id == Seat.id)
         
         if library_id:
-            query = query.filter_by(library_id=library_id)
+            query = query.where(Booking.library_id == library_id)
         
         if start_date:
-            query = query.filter(Booking.date >= start_date)
+            query = query.where(Booking.date >= start_date)
         
         if end_date:
-            query = query.filter(Booking.date <= end_date)
-        
-        bookings = query.order_by(Booking.date.desc()).all()
+            query = query.where(Booking.date <= end_date)
         
-        # Create CSV in memory
-        output = io.StringIO()
-        writer = csv.writer(output)
-        
-        # Write header
-        writer.writerow([
-            'Booking ID', 'Library', 'User', 'Seat Number', 
-            'Date', 'Time Slot', 'Status', 'Created At'
-        ])
+        query = query.order_by(Booking.date.desc(), Booking.id.desc()).execution_options(
+            stream_results=True, yield_per=EXPORT_CHUNK_ROWS
+        )
         
-        # Write data
-        for booking in bookings:
+        def generate():
+            output = io.StringIO()
+            writer = csv.writer(output)
+            
+            # Write header
             writer.writerow([
-                booking.id,
-                booking.library.name,
-                booking.user.username,
-                booking.seat.number,
-                booking.date.strftime('%Y-%m-%d'),
-                booking.time_slot.strftime('%H:%M'),
-                booking.status.value,
-                booking.created_at.strftime('%Y-%m-%d %H:%M:%S')
+                'Booking ID', 'Library', 'User', 'Seat Number', 
+                'Date', 'Time Slot', 'Status', 'Created At'
             ])
+            
+            # Write data one chunk at a time
+            for chunk in db.session.execute(query).partitions():
+                for booking_id, library_name, username, seat_number, booking_date, time_slot, status, created_at in chunk:
+                    writer.writerow([
+                        booking_id,
+                        library_name,
+                        username,
+                        seat_number,
+                        booking_date.strftime('%Y-%m-%d'),
+                        time_slot.strftime('%H:%M'),
+                        status.value,
+                        created_at.strftime('%Y-%m-%d %H:%M:%S') if created_at else ''
+                    ])
+                yield output.getvalue()
+                output.seek(0)
+                output.truncate()
+            
+            # Header only, when there were no rows
+            if output.tell():
+                yield output.getvalue()
         
         # Create response
-        output.seek(0)
-        response = make_response(output.getvalue())
-        response.headers['Content-Type'] = 'text/csv'
+        response = Response(stream_with_context(generate()), mimetype='text/csv')
         response.headers['Content-Disposition'] = f'attachment; filename=bookings_{datetime.now().strftime("%Y%m%d")}.csv'
+        # Let nginx pass chunks straight through instead of buffering the file
+        response.headers['X-Accel-Buffering'] = 'no'
         
         return response
     
@@ -293,31 +365,36 @@ class AnalyticsService:
     
     @staticmethod
     def get_peak_hours(library_id=None, days=30):
-        """Get peak booking hours - PostgreSQL compatible"""
+        """Get peak booking hours"""
         start_date = date.today() - timedelta(days=days)
         
-        # Use PostgreSQL to_char instead of SQLite strftime
-        # Format: to_char(time_column, 'HH24') for 24-hour format
         query = db.session.query(
-            func.to_char(Booking.time_slot, 'HH24').label('hour'),
-            func.count(Booking.id).label('count')
+            BookingRollup.hour,
+            func.sum(BookingRollup.count).label('count')
         ).filter(
-            Booking.date >= start_date
+            BookingRollup.date >= start_date
         )
         
         if library_id:
-            query = query.filter(Booking.library_id == library_id)
+            query = query.filter(BookingRollup.library_id == library_id)
         
-        results = query.group_by('hour').order_by('hour').all()
+        results = query.group_by(BookingRollup.hour).having(
+            func.sum(BookingRollup.count) > 0
+        ).order_by(BookingRollup.hour).all()
         
         return [
             {
-                'hour': f"{hour}:00",
+                'hour': f"{hour:02d}:00",
                 'count': count
             }
             for hour, count in results
         ]
     
+    @staticmethod
+    def get_pending_gallery_count():
+        """Gallery images awaiting CSR approval"""
+        return GalleryImage.query.filter_by(status=GalleryStatus.pending).count()
+    
     @staticmethod
     def get_user_statistics():
         """Get user-related statistics"""
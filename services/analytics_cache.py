@@ -0,0 +1,76 @@
+"""
+Analytics Cache
+Process-local results of AnalyticsService calls for the CSR dashboards
+"""
+
+import json
+import threading
+from services.cache import TTLCache, MISSING
+
+# Upper bound on staleness for changes made in another process (other web
+# workers, the background worker); changes made in this process invalidate
+# the cache immediately
+ANALYTICS_TTL_SECONDS = 300
+
+# Lifetime of results cached with get_public(), which invalidate() leaves
+# alone so booking writes cannot empty it on busy public pages
+PUBLIC_TTL_SECONDS = 60
+
+
+class AnalyticsCache:
+    """
+    Results keyed by method and arguments, dropped whenever the generation
+    counter is bumped. Booking writes call invalidate() after committing.
+    Cached results are shared between requests: treat them as read-only.
+    """
+
+    _cache = TTLCache(ttl=ANALYTICS_TTL_SECONDS, maxsize=256)
+    _public = TTLCache(ttl=PUBLIC_TTL_SECONDS, maxsize=16)
+    _generation = 0
+    _lock = threading.Lock()
+
+    @staticmethod
+    def get(method, **kwargs):
+        """Return method(**kwargs), computing it only on a cache miss"""
+        key = (method.__name__, tuple(sorted(kwargs.items())))
+        return AnalyticsCache._get(key, lambda: method(**kwargs))
+
+    @staticmethod
+    def get_json(method, **kwargs):
+        """method(**kwargs) serialized to JSON bytes, cached as bytes"""
+        key = ('json', method.__name__, tuple(sorted(kwargs.items())))
+        return AnalyticsCache._get(
+            key, lambda: json.dumps(AnalyticsCache.get(method, **kwargs)).encode()
+        )
+
+    @staticmethod
+    def get_public(method, **kwargs):
+        """
+        method(**kwargs) cached for PUBLIC_TTL_SECONDS regardless of
+        writes; only for results that may be that stale (no booking counts)
+        """
+        key = (method.__name__, tuple(sorted(kwargs.items())))
+        value = AnalyticsCache._public.get(key)
+        if value is MISSING:
+            value = method(**kwargs)
+            AnalyticsCache._public.set(key, value)
+        return value
+
+    @staticmethod
+    def _get(key, compute):
+        value = AnalyticsCache._cache.get(key)
+        if value is MISSING:
+            generation = AnalyticsCache._generation
+            value = compute()
+            with AnalyticsCache._lock:
+                # Skip the write if an invalidation raced with our queries
+                if generation == AnalyticsCache._generation:
+                    AnalyticsCache._cache.set(key, value)
+        return value
+
+    @staticmethod
+    def invalidate():
+        """Bump the generation; call after bookings (or other counted data) change"""
+        with AnalyticsCache._lock:
+            AnalyticsCache._generation += 1
+            AnalyticsCache._cache.clear()
@@ -0,0 +1,267 @@
+"""
+Availability Service
+In-memory seat x slot availability bitmaps for the seat booking pages
+"""
+
+import threading
+import time as clock
+from models import db, Seat, Booking, BookingStatus
+from services.cache import TTLCache, MISSING
+
+# Seconds a grid or seat roster is trusted before it is rebuilt from the
+# database. Writes made in this process update the grids in place; the TTL
+# only bounds how long another worker's writes can go unseen.
+GRID_TTL_SECONDS = 60
+ROSTER_TTL_SECONDS = 60
+
+
+class DayGrid:
+    """Booked slots for one library on one date, one bitmask per seat"""
+
+    __slots__ = ('slots', 'slot_index', 'booked', 'built_at')
+
+    def __init__(self, slots, built_at):
+        self.slots = []
+        self.slot_index = {}
+        self.booked = {}  # seat_id -> int, bit i set when slots[i] is booked
+        self.built_at = built_at
+        for slot in slots:
+            self._index_of(slot)
+
+    def _index_of(self, time_slot):
+        """Return the bit position of a slot, registering it if unseen"""
+        idx = self.slot_index.get(time_slot)
+        if idx is None:
+            idx = len(self.slots)
+            self.slots.append(time_slot)
+            self.slot_index[time_slot] = idx
+        return idx
+
+    def is_booked(self, seat_id, time_slot):
+        """O(1) check whether a seat is booked for a slot"""
+        idx = self.slot_index.get(time_slot)
+        if idx is None:
+            return False
+        return bool((self.booked.get(seat_id, 0) >> idx) & 1)
+
+    def set_booked(self, seat_id, time_slot, booked=True):
+        """Set or clear the bit for a seat/slot pair"""
+        bit = 1 << self._index_of(time_slot)
+        mask = self.booked.get(seat_id, 0)
+        mask = (mask | bit) if booked else (mask & ~bit)
+        if mask:
+            self.booked[seat_id] = mask
+        else:
+            self.booked.pop(seat_id, None)
+
+    def booked_seat_ids(self, time_slot):
+        """Set of seat IDs booked for one slot"""
+        idx = self.slot_index.get(time_slot)
+        if idx is None:
+            return set()
+        bit = 1 << idx
+        return {seat_id for seat_id, mask in self.booked.items() if mask & bit}
+
+
+class AvailabilityService:
+    """Process-local availability engine keyed by (library_id, date)"""
+
+    _lock = threading.Lock()
+    _grids = {}        # (library_id, date) -> DayGrid
+    _generations = {}  # (library_id, date) -> int, bumped by every write
+    _rosters = TTLCache(ttl=ROSTER_TTL_SECONDS)  # library_id -> (seat rows, {seat_id: row})
+    _roster_generations = {}  # library_id -> int, bumped by invalidate_roster()
+
+    # ============= Seat roster =============
+
+    @staticmethod
+    def get_seat_roster(library_id):
+        """
+        Ordered seats for a library as (id, number, category, in_maintenance)
+        tuples. Cached per process and invalidated by seat writes.
+        """
+        return AvailabilityService._load_roster(library_id)[0]
+
+    @staticmethod
+    def get_seat(library_id, seat_id):
+        """Roster row (id, number, category, in_maintenance) for one seat, or None"""
+        return AvailabilityService._load_roster(library_id)[1].get(seat_id)
+
+    @staticmethod
+    def _load_roster(library_id):
+        cached = AvailabilityService._rosters.get(library_id)
+        if cached is not MISSING:
+            return cached
+        with AvailabilityService._lock:
+            generation = AvailabilityService._roster_generations.get(library_id, 0)
+
+        rows = db.session.query(
+            Seat.id, Seat.number, Seat.category, Seat.in_maintenance
+        ).filter(
+            Seat.library_id == library_id
+        ).order_by(Seat.sort_key).all()
+
+        roster = tuple(
+            (seat_id, number, category.value, bool(in_maintenance))
+            for seat_id, number, category, in_maintenance in rows
+        )
+        cached = (roster, {row[0]: row for row in roster})
+        with AvailabilityService._lock:
+            # Skip the write if the seats changed while we were querying
+            if AvailabilityService._roster_generations.get(library_id, 0) == generation:
+                AvailabilityService._rosters.set(library_id, cached)
+        return cached
+
+    @staticmethod
+    def invalidate_roster(library_id):
+        """Drop the cached seat roster after seats are added, removed or edited"""
+        with AvailabilityService._lock:
+            AvailabilityService._roster_generations[library_id] = \
+                AvailabilityService._roster_generations.get(library_id, 0) + 1
+            AvailabilityService._rosters.pop(library_id)
+
+    # ============= Day grids =============
+
+    @staticmethod
+    def get_day_grid(library_id, day, time_slots=()):
+        """Return the availability grid for a library/date, building it with one query"""
+        key = (library_id, day)
+        now = clock.monotonic()
+
+        with AvailabilityService._lock:
+            grid = AvailabilityService._grids.get(key)
+            if grid and now - grid.built_at < GRID_TTL_SECONDS:
+                return grid
+            generation = AvailabilityService._generations.get(key, 0)
+
+        rows = db.session.query(Booking.seat_id, Booking.time_slot).filter(
+            Booking.library_id == library_id,
+            Booking.date == day,
+            Booking.status == BookingStatus.booked
+        ).all()
+
+        grid = DayGrid(time_slots, now)
+        for seat_id, time_slot in rows:
+            grid.set_booked(seat_id, time_slot)
+
+        with AvailabilityService._lock:
+            # A write landed while we were querying; serve this grid but let
+            # the next caller rebuild rather than caching a stale snapshot.
+            if AvailabilityService._generations.get(key, 0) == generation:
+                AvailabilityService._prune(now)
+                AvailabilityService._grids[key] = grid
+
+        return grid
+
+    @staticmethod
+    def _prune(now):
+        """Evict expired grids (caller holds the lock)"""
+        expired = [
+            key for key, grid in AvailabilityService._grids.items()
+            if now - grid.built_at >= GRID_TTL_SECONDS
+        ]
+        for key in expired:
+            del AvailabilityService._grids[key]
+
+    @staticmethod
+    def is_booked(library_id, day, seat_id, time_slot):
+        """O(1) check whether a seat is taken for a slot"""
+        grid = AvailabilityService.get_day_grid(library_id, day)
+        return grid.is_booked(seat_id, time_slot)
+
+    @staticmethod
+    def get_seat_map(library_id, day, time_slot, time_slots=()):
+        """Seat status list for the seat map page"""
+        roster = AvailabilityService.get_seat_roster(library_id)
+        grid = AvailabilityService.get_day_grid(library_id, day, time_slots)
+
+        seats_data = []
+        for seat_id, number, category, in_maintenance in roster:
+            if in_maintenance:
+                status = 'maintenance'
+            elif time_slot and grid.is_booked(seat_id, time_slot):
+                status = 'booked'
+            else:
+                status = 'available'
+            seats_data.append({
+                'id': seat_id,
+                'number': number,
+                'category': category,
+                'status': status,
+                'in_maintenance': in_maintenance
+            })
+
+        return seats_data
+
+    @staticmethod
+    def get_day_matrix(library_id, day, time_slots):
+        """
+        Whole-day availability for every seat and slot, packed for JSON.
+        Each seat row carries a bitstring where character i is '1' when
+        time_slots[i] is booked.
+        """
+        roster = AvailabilityService.get_seat_roster(library_id)
+        grid = AvailabilityService.get_day_grid(library_id, day, time_slots)
+        positions = [grid.slot_index.get(slot) for slot in time_slots]
+
+        seats = []
+        for seat_id, number, category, in_maintenance in roster:
+            mask = grid.booked.get(seat_id, 0)
+            bits = ''.join(
+                '1' if idx is not None and (mask >> idx) & 1 else '0'
+                for idx in positions
+            )
+            seats.append([seat_id, number, category, int(in_maintenance), bits])
+
+        return {
+            'date': day.isoformat(),
+            'slots': [slot.strftime('%H:%M:%S') for slot in time_slots],
+            'fields': ['id', 'number', 'category', 'maintenance', 'booked'],
+            'seats': seats
+        }
+
+    # ============= Write hooks (call after commit) =============
+
+    @staticmethod
+    def _apply(library_id, day, seat_id, time_slot, booked):
+        key = (library_id, day)
+        with AvailabilityService._lock:
+            AvailabilityService._generations[key] = AvailabilityService._generations.get(key, 0) + 1
+            grid = AvailabilityService._grids.get(key)
+            if grid:
+                grid.set_booked(seat_id, time_slot, booked)
+
+    @staticmethod
+    def mark_booked(library_id, day, seat_id, time_slot):
+        """Record a new booking in the cached grid"""
+        AvailabilityService._apply(library_id, day, seat_id, time_slot, True)
+
+    @staticmethod
+    def mark_free(library_id, day, seat_id, time_slot):
+        """Record a cancelled booking in the cached grid"""
+        AvailabilityService._apply(library_id, day, seat_id, time_slot, False)
+
+    @staticmethod
+    def release_booking(booking):
+        """Shortcut for mark_free from a Booking row"""
+        AvailabilityService.mark_free(
+            booking.library_id, booking.date, booking.seat_id, booking.time_slot
+        )
+
+    @staticmethod
+    def invalidate(library_id, day=None):
+        """Drop cached grids for a library (one date, or all dates)"""
+        with AvailabilityService._lock:
+            keys = [
+                key for key in AvailabilityService._grids
+                if key[0] == library_id and (day is None or key[1] == day)
+            ]
+            for key in keys:
+                del AvailabilityService._grids[key]
+            if day is not None:
+                key = (library_id, day)
+                AvailabilityService._generations[key] = AvailabilityService._generations.get(key, 0) + 1
+            else:
+                for key in list(AvailabilityService._generations):
+                    if key[0] == library_id:
+                        AvailabilityService._generations[key] += 1
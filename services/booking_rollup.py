@@ -0,0 +1,147 @@
+"""
+Booking Rollup Service
+Booking counts per library/day/hour/status, maintained on write
+"""
+
+from collections import Counter
+from sqlalchemy import Integer, cast, extract, func, text
+from sqlalchemy.dialects import postgresql, sqlite
+from models import db, Booking, BookingRollup, BookingStatus
+from services.analytics_cache import AnalyticsCache
+
+ROLLUP_KEY = ('library_id', 'date', 'hour', 'status')
+
+
+class BookingRollupService:
+    """
+    Every booking write calls one of the update helpers before committing,
+    so the rollup changes in the same transaction as the bookings. The key
+    holds only booking columns that never change after creation (and the
+    status, which is moved explicitly), so decrements always hit the
+    bucket that was incremented. rebuild() recounts everything from the
+    booking table.
+    """
+
+    # ============= Updates (call before commit) =============
+
+    @staticmethod
+    def booking_added(library_id, day, time_slot, status=BookingStatus.booked):
+        """Count a newly created booking"""
+        BookingRollupService._apply({(library_id, day, time_slot.hour, status): 1})
+
+    @staticmethod
+    def status_changed(booking, old_status):
+        """Move one booking from its old status to booking.status"""
+        key = (booking.library_id, booking.date, booking.time_slot.hour)
+        BookingRollupService._apply({
+            key + (old_status,): -1,
+            key + (booking.status,): 1
+        })
+
+    @staticmethod
+    def bookings_transitioned(booking_ids, old_status, new_status):
+        """
+        Move a set of bookings between statuses (after a set-based UPDATE):
+        one grouped SELECT and one upsert, however many bookings.
+        """
+        booking_ids = list(booking_ids)
+        if not booking_ids:
+            return
+        hour = cast(extract('hour', Booking.time_slot), Integer)
+        rows = db.session.query(
+            Booking.library_id, Booking.date, hour, func.count(Booking.id)
+        ).filter(
+            Booking.id.in_(booking_ids)
+        ).group_by(
+            Booking.library_id, Booking.date, hour
+        ).all()
+
+        deltas = Counter()
+        for library_id, day, hour, count in rows:
+            deltas[(library_id, day, hour, old_status)] -= count
+            deltas[(library_id, day, hour, new_status)] += count
+        BookingRollupService._apply(deltas)
+
+    @staticmethod
+    def seats_deleted(seat_ids):
+        """
+        Uncount the bookings of seats about to be deleted (their bookings
+        are deleted with them). Call before db.session.delete().
+        """
+        hour = cast(extract('hour', Booking.time_slot), Integer)
+        rows = db.session.query(
+            Booking.library_id, Booking.date, hour, Booking.status, func.count(Booking.id)
+        ).filter(
+            Booking.seat_id.in_(list(seat_ids))
+        ).group_by(
+            Booking.library_id, Booking.date, hour, Booking.status
+        ).all()
+        BookingRollupService._apply({tuple(row[:4]): -row[4] for row in rows})
+
+    @staticmethod
+    def library_deleted(library_id):
+        """Drop a deleted library's rollup rows"""
+        db.session.execute(
+            db.delete(BookingRollup).where(BookingRollup.library_id == library_id)
+        )
+
+    @staticmethod
+    def _apply(deltas):
+        """Add {rollup key: delta} to the table with a single upsert statement"""
+        rows = [
+            dict(zip(ROLLUP_KEY, key), count=delta)
+            for key, delta in deltas.items() if delta
+        ]
+        if not rows:
+            return
+        dialect = postgresql if db.engine.dialect.name == 'postgresql' else sqlite
+        stmt = dialect.insert(BookingRollup)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=list(ROLLUP_KEY),
+            set_={'count': BookingRollup.count + stmt.excluded.count}
+        )
+        db.session.execute(stmt, rows)
+
+    # ============= Rebuild =============
+
+    @staticmethod
+    def lock():
+        """
+        On PostgreSQL, hold off every other rollup writer (including other
+        rebuilds) until the current transaction ends. Writers that got in
+        first are waited for, so their bookings are visible to the recount.
+        """
+        if db.engine.dialect.name == 'postgresql':
+            db.session.execute(text('LOCK TABLE booking_rollup IN EXCLUSIVE MODE'))
+
+    @staticmethod
+    def rebuild(library_id=None):
+        """
+        Recount the rollup from the booking table (optionally for one
+        library) in one DELETE and one INSERT ... SELECT, then commit.
+        Returns the number of rollup rows written.
+        """
+        BookingRollupService.lock()
+        hour = cast(extract('hour', Booking.time_slot), Integer)
+        source = db.select(
+            Booking.library_id, Booking.date, hour.label('hour'),
+            Booking.status, func.count(Booking.id)
+        ).group_by(
+            Booking.library_id, Booking.date, hour, Booking.status
+        )
+        clear = db.delete(BookingRollup)
+        if library_id:
+            source = source.where(Booking.library_id == library_id)
+            clear = clear.where(BookingRollup.library_id == library_id)
+
+        db.session.execute(clear)
+        db.session.execute(
+            db.insert(BookingRollup).from_select(list(ROLLUP_KEY) + ['count'], source)
+        )
+        db.session.commit()
+        AnalyticsCache.invalidate()
+
+        query = db.session.query(func.count()).select_from(BookingRollup)
+        if library_id:
+            query = query.filter(BookingRollup.library_id == library_id)
+        return query.scalar()
@@ -4,7 +4,12 @@ Handles bulk seat management and booking operations
 """
 
 from models import db, Seat, SeatCategory, Booking, BookingStatus
-from datetime import date
+from services.availability_service import AvailabilityService
+from services.expiry_wheel import NoShowExpiryWheel
+from services.checkin_hub import CheckinHub
+from services.booking_rollup import BookingRollupService
+from services.analytics_cache import AnalyticsCache
+from datetime import date, datetime
 
 class BulkOperationsService:
     
@@ -35,6 +40,7 @@ class BulkOperationsService:
             created.append(num)
         
         db.session.commit()
+        AvailabilityService.invalidate_roster(library_id)
         return created, errors
     
     @staticmethod
@@ -57,6 +63,7 @@ class BulkOperationsService:
             updated.append(num)
         
         db.session.commit()
+        AvailabilityService.invalidate_roster(library_id)
         return updated, errors
     
     @staticmethod
@@ -79,31 +86,49 @@ class BulkOperationsService:
             updated.append(num)
         
         db.session.commit()
+        AvailabilityService.invalidate_roster(library_id)
         return updated, errors
     
     @staticmethod
     def bulk_cancel_bookings(library_id, booking_date):
-        """Cancel all bookings for a specific date"""
-        bookings = Booking.query.filter_by(
-            library_id=library_id,
-            date=booking_date,
-            status=BookingStatus.booked
-        ).all()
-        
-        cancelled_count = 0
-        for booking in bookings:
-            booking.status = BookingStatus.cancelled
-            cancelled_count += 1
-            
-            # Send cancellation email (optional - may cause delays if many bookings)
-            try:
-                from services.email_service import EmailService
-                EmailService.send_cancellation_email(booking)
-            except:
-                pass  # Don't fail if email fails
+        """
+        Cancel all bookings for a specific date. Notification emails are
+        rendered in one pass and queued in the same transaction; the outbox
+        sender delivers them over pooled SMTP connections and records the
+        result for each recipient.
+        """
+        from services.email_service import EmailService
+        
+        # Cancel in one UPDATE ... RETURNING so only rows this statement
+        # changed get an email, then fetch their email data in one join
+        cancelled_ids = db.session.execute(
+            db.update(Booking).where(
+                Booking.library_id == library_id,
+                Booking.date == booking_date,
+                Booking.status == BookingStatus.booked
+            ).values(
+                status=BookingStatus.cancelled,
+                updated_at=datetime.utcnow()
+            ).returning(Booking.id)
+        ).scalars().all()
+        
+        rows = []
+        if cancelled_ids:
+            rows = EmailService.booking_rows_query().filter(
+                Booking.id.in_(cancelled_ids)
+            ).all()
+        
+        EmailService.queue_booking_emails('cancellation', rows)
+        BookingRollupService.bookings_transitioned(
+            cancelled_ids, BookingStatus.booked, BookingStatus.cancelled
+        )
         
         db.session.commit()
-        return cancelled_count
+        AvailabilityService.invalidate(library_id, booking_date)
+        NoShowExpiryWheel.discard_many(cancelled_ids)
+        CheckinHub.bookings_cancelled(library_id, cancelled_ids)
+        AnalyticsCache.invalidate()
+        return len(cancelled_ids)
     
     @staticmethod
     def bulk_delete_seats(library_id, seat_numbers):
@@ -131,10 +156,13 @@ class BulkOperationsService:
                 errors.append(f"Seat {num} has {future_bookings} future bookings")
                 continue
             
+            BookingRollupService.seats_deleted([seat.id])
             db.session.delete(seat)
             deleted.append(num)
         
         db.session.commit()
+        AvailabilityService.invalidate_roster(library_id)
+        AnalyticsCache.invalidate()
         return deleted, errors
     
     @staticmethod
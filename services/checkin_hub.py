@@ -0,0 +1,154 @@
+"""
+Check-in Hub
+In-process fan-out of booking events to the live reporting desk (Server-Sent Events)
+"""
+
+import json
+import queue
+import threading
+import time as clock
+from datetime import date, datetime, timedelta
+
+# Each open stream occupies a gunicorn thread, so only a few are allowed per
+# process (the CHECKIN_MAX_STREAMS setting, by default a quarter of the
+# worker's threads); desks beyond the cap poll the state endpoint instead
+DEFAULT_MAX_STREAMS = 1
+
+# Streams end after this long and the browser's EventSource reconnects,
+# which keeps a stuck connection from holding a thread forever
+STREAM_SECONDS = 300
+HEARTBEAT_SECONDS = 15
+
+# Events buffered per subscriber before it is considered stuck and dropped
+SUBSCRIBER_QUEUE_SIZE = 200
+
+
+class CheckinHub:
+    """
+    Per-library subscriber queues fed by the booking write paths. Events
+    only reach streams in the publishing process, so the desk also reloads
+    its state snapshot whenever a stream (re)connects and once a minute.
+    """
+
+    _lock = threading.Lock()
+    _subscribers = {}  # library_id -> set of queue.Queue
+
+    # ============= Subscribers =============
+
+    @staticmethod
+    def subscribe(library_id, max_streams=DEFAULT_MAX_STREAMS):
+        """Register a stream; returns its queue, or None when at capacity"""
+        with CheckinHub._lock:
+            total = sum(len(queues) for queues in CheckinHub._subscribers.values())
+            if total >= max_streams:
+                return None
+            subscriber = queue.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+            CheckinHub._subscribers.setdefault(library_id, set()).add(subscriber)
+            return subscriber
+
+    @staticmethod
+    def unsubscribe(library_id, subscriber):
+        with CheckinHub._lock:
+            queues = CheckinHub._subscribers.get(library_id)
+            if queues is not None:
+                queues.discard(subscriber)
+                if not queues:
+                    del CheckinHub._subscribers[library_id]
+
+    @staticmethod
+    def stream(library_id, subscriber):
+        """Yield SSE frames for one subscriber until the stream times out"""
+        try:
+            # Ask the browser to reconnect quickly after we close the stream
+            yield 'retry: 3000\n\n'
+            yield CheckinHub._frame('hello', {
+                'server_time': datetime.now().isoformat(timespec='seconds')
+            })
+            deadline = clock.monotonic() + STREAM_SECONDS
+            while clock.monotonic() < deadline:
+                try:
+                    event, data = subscriber.get(timeout=HEARTBEAT_SECONDS)
+                except queue.Empty:
+                    yield ': ping\n\n'
+                    continue
+                yield CheckinHub._frame(event, data)
+        finally:
+            CheckinHub.unsubscribe(library_id, subscriber)
+
+    @staticmethod
+    def _frame(event, data):
+        return f'event: {event}\ndata: {json.dumps(data)}\n\n'
+
+    # ============= Publishing (call after commit) =============
+
+    @staticmethod
+    def publish(library_id, event, data):
+        """Fan an event out to every stream watching a library"""
+        with CheckinHub._lock:
+            queues = list(CheckinHub._subscribers.get(library_id, ()))
+        for subscriber in queues:
+            try:
+                subscriber.put_nowait((event, data))
+            except queue.Full:
+                # A stream that stopped reading; drop it rather than block writers
+                CheckinHub.unsubscribe(library_id, subscriber)
+
+    @staticmethod
+    def has_subscribers(library_id):
+        """Cheap check so write paths can skip building event payloads"""
+        return library_id in CheckinHub._subscribers
+
+    @staticmethod
+    def pending_item(booking_id, username, seat_number, slot_start, grace_end):
+        """A pending card as sent to the desk, in events and in its state snapshot"""
+        return {
+            'booking_id': booking_id,
+            'username': username,
+            'seat_number': seat_number,
+            'time_label': slot_start.strftime('%I:%M %p'),
+            'slot_start': slot_start.isoformat(timespec='seconds'),
+            'grace_end': grace_end.isoformat(timespec='seconds')
+        }
+
+    @staticmethod
+    def reported_item(booking_id, username, seat_number, time_slot, reported_at):
+        """A reported card as sent to the desk, in events and in its state snapshot"""
+        return {
+            'booking_id': booking_id,
+            'username': username,
+            'seat_number': seat_number,
+            'time_label': time_slot.strftime('%I:%M %p'),
+            'reported_label': reported_at.strftime('%I:%M %p')
+        }
+
+    @staticmethod
+    def booking_created(library_id, booking_id, day, username, seat_number, time_slot, grace_minutes):
+        """A booking for today was made; it joins the pending list"""
+        if day != date.today() or not CheckinHub.has_subscribers(library_id):
+            return
+        slot_start = datetime.combine(day, time_slot)
+        CheckinHub.publish(library_id, 'booking', CheckinHub.pending_item(
+            booking_id, username, seat_number,
+            slot_start, slot_start + timedelta(minutes=grace_minutes)
+        ))
+
+    @staticmethod
+    def booking_reported(library_id, booking_id, username, seat_number, time_slot, reported_at):
+        """A user checked in; the card moves from pending to reported"""
+        if not CheckinHub.has_subscribers(library_id):
+            return
+        CheckinHub.publish(library_id, 'reported', CheckinHub.reported_item(
+            booking_id, username, seat_number, time_slot, reported_at
+        ))
+
+    @staticmethod
+    def bookings_cancelled(library_id, booking_ids, reason='cancelled'):
+        """Bookings left the pending list (cancelled or auto-cancelled)"""
+        if not CheckinHub.has_subscribers(library_id):
+            return
+        booking_ids = list(booking_ids)
+        if booking_ids:
+            CheckinHub.publish(library_id, 'cancelled', {
+                'booking_ids': booking_ids,
+                'reason': reason
+            })
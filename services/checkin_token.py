@@ -0,0 +1,149 @@
+"""
+Check-in Token Service
+HMAC-signed booking tokens carried in QR codes and verified at the kiosk
+"""
+
+import base64
+import hashlib
+import hmac
+import io
+from collections import namedtuple
+from datetime import datetime, timedelta
+from flask import current_app
+
+TOKEN_VERSION = '1'
+
+# Truncated HMAC-SHA256; 128 bits is ample for a token that expires the
+# same day and keeps the QR code small enough to scan quickly
+MAC_BYTES = 16
+
+# Kiosk check-in opens this long before the slot starts
+CHECKIN_OPENS_MINUTES = 60
+
+# Verified token contents. slot_start and expires_at are naive local
+# datetimes, like Booking.date/time_slot.
+CheckinClaims = namedtuple('CheckinClaims', [
+    'booking_id', 'library_id', 'seat_number', 'slot_start', 'expires_at'
+])
+
+_TIME_FORMAT = '%Y%m%d%H%M'
+
+
+def _b64encode(raw):
+    return base64.urlsafe_b64encode(raw).rstrip(b'=').decode('ascii')
+
+
+def _b64decode(text):
+    return base64.urlsafe_b64decode(text + '=' * (-len(text) % 4))
+
+
+class CheckinTokenService:
+    """Issue and verify check-in tokens without touching the database"""
+
+    _keys = {}  # SECRET_KEY -> derived signing key
+
+    @staticmethod
+    def _key():
+        secret = current_app.config['SECRET_KEY']
+        key = CheckinTokenService._keys.get(secret)
+        if key is None:
+            # Derive a dedicated key so these MACs can never be confused
+            # with anything else signed with SECRET_KEY (e.g. the session)
+            key = hmac.new(secret.encode(), b'kaluwala-checkin-token', hashlib.sha256).digest()
+            CheckinTokenService._keys[secret] = key
+        return key
+
+    @staticmethod
+    def _mac(body):
+        return hmac.new(CheckinTokenService._key(), body, hashlib.sha256).digest()[:MAC_BYTES]
+
+    # ============= Issuing =============
+
+    @staticmethod
+    def issue(booking_id, library_id, seat_number, day, time_slot, grace_minutes):
+        """Signed token for one booking; valid until its grace period ends"""
+        slot_start = datetime.combine(day, time_slot)
+        expires_at = slot_start + timedelta(minutes=grace_minutes)
+        body = '|'.join([
+            TOKEN_VERSION, str(booking_id), str(library_id), str(seat_number),
+            slot_start.strftime(_TIME_FORMAT), expires_at.strftime(_TIME_FORMAT)
+        ]).encode()
+        return f"{_b64encode(body)}.{_b64encode(CheckinTokenService._mac(body))}"
+
+    @staticmethod
+    def issue_for_booking(booking):
+        return CheckinTokenService.issue(
+            booking.id, booking.library_id, booking.seat.number,
+            booking.date, booking.time_slot, booking.grace_period_minutes
+        )
+
+    @staticmethod
+    def issue_for_row(row):
+        """Token for a BookingEmailRow"""
+        return CheckinTokenService.issue(
+            row.booking_id, row.library_id, row.seat_number,
+            row.date, row.time_slot, row.grace_period_minutes
+        )
+
+    # ============= Verification =============
+
+    @staticmethod
+    def verify(token):
+        """
+        Check the signature and decode the claims.
+        Returns (claims, None) or (None, error message).
+        """
+        try:
+            body_part, mac_part = token.strip().split('.')
+            body = _b64decode(body_part)
+            mac = _b64decode(mac_part)
+        except (ValueError, AttributeError):
+            return None, "Unreadable check-in code"
+
+        if not hmac.compare_digest(mac, CheckinTokenService._mac(body)):
+            return None, "Invalid check-in code"
+
+        try:
+            version, booking_id, library_id, seat_number, slot_start, expires_at = body.decode().split('|')
+            if version != TOKEN_VERSION:
+                raise ValueError(version)
+            claims = CheckinClaims(
+                int(booking_id), int(library_id), seat_number,
+                datetime.strptime(slot_start, _TIME_FORMAT),
+                datetime.strptime(expires_at, _TIME_FORMAT)
+            )
+        except ValueError:
+            return None, "Unsupported check-in code"
+
+        return claims, None
+
+    @staticmethod
+    def check_window(claims, now=None):
+        """Error message if the token cannot be used right now, else None"""
+        now = now or datetime.now()
+        if claims.slot_start.date() != now.date():
+            return "This booking is not for today"
+        if now > claims.expires_at:
+            return "Grace period expired. Booking will be auto-cancelled."
+        if now < claims.slot_start - timedelta(minutes=CHECKIN_OPENS_MINUTES):
+            opens = claims.slot_start - timedelta(minutes=CHECKIN_OPENS_MINUTES)
+            return f"Check-in opens at {opens.strftime('%I:%M %p')}"
+        return None
+
+    # ============= QR codes =============
+
+    @staticmethod
+    def qr_png(token):
+        """PNG bytes of a QR code holding the token"""
+        import qrcode
+
+        code = qrcode.QRCode(
+            error_correction=qrcode.constants.ERROR_CORRECT_M,
+            box_size=8,
+            border=2
+        )
+        code.add_data(token)
+        code.make(fit=True)
+        buffer = io.BytesIO()
+        code.make_image().save(buffer, format='PNG')
+        return buffer.getvalue()
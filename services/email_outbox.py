@@ -0,0 +1,148 @@
+"""
+Email Outbox
+Transactional outbox for notification emails, drained by a background sender
+"""
+
+from datetime import datetime, timedelta
+from models import db, EmailOutbox, OutboxStatus
+
+# Messages claimed and sent per SMTP connection
+OUTBOX_BATCH_SIZE = 50
+
+# Retry delay doubles with each failed attempt (30s, 1m, 2m, ...) up to the
+# cap; after the last attempt the message is marked failed.
+OUTBOX_MAX_ATTEMPTS = 6
+OUTBOX_BASE_DELAY_SECONDS = 30
+OUTBOX_MAX_DELAY_SECONDS = 3600
+
+# Sent messages are kept this long for troubleshooting, then purged
+OUTBOX_RETENTION_DAYS = 7
+
+
+class EmailOutboxService:
+    """Queue emails with the database change they report and send them later"""
+
+    @staticmethod
+    def enqueue(to, subject, html):
+        """
+        Add a message to the current session. Nothing is sent unless the
+        caller's transaction commits.
+        """
+        message = EmailOutbox(
+            recipient=to if isinstance(to, str) else ','.join(to),
+            subject=subject,
+            html=html,
+            status=OutboxStatus.pending,
+            attempts=0,
+            next_attempt_at=datetime.utcnow()
+        )
+        db.session.add(message)
+        return message
+
+    @staticmethod
+    def enqueue_many(messages, send_at=None, spacing_seconds=0):
+        """
+        Add pre-rendered messages (dicts with to, subject, template) with a
+        single multi-row INSERT in the current transaction. The first message
+        is due at send_at (default now); a non-zero spacing_seconds staggers
+        the rest to cap the delivery rate. Returns the count.
+        """
+        now = datetime.utcnow()
+        send_at = send_at or now
+        rows = [
+            {
+                'recipient': item['to'] if isinstance(item['to'], str) else ','.join(item['to']),
+                'subject': item['subject'],
+                'html': item['template'],
+                'status': OutboxStatus.pending,
+                'attempts': 0,
+                'next_attempt_at': send_at + timedelta(seconds=position * spacing_seconds),
+                'created_at': now
+            }
+            for position, item in enumerate(messages)
+        ]
+        if rows:
+            db.session.execute(db.insert(EmailOutbox), rows)
+        return len(rows)
+
+    @staticmethod
+    def send_pending(batch_size=OUTBOX_BATCH_SIZE, max_batches=20):
+        """Drain due messages batch by batch. Returns (sent, failed) totals"""
+        total_sent = total_failed = 0
+        for _ in range(max_batches):
+            sent, failed = EmailOutboxService.send_batch(batch_size)
+            total_sent += sent
+            total_failed += failed
+            if sent + failed < batch_size:
+                break
+        return total_sent, total_failed
+
+    @staticmethod
+    def send_batch(batch_size=OUTBOX_BATCH_SIZE):
+        """
+        Claim up to batch_size due messages and send them over a single SMTP
+        connection. Failures are rescheduled with exponential backoff.
+        Returns (sent, failed) counts.
+        """
+        from services.email_service import EmailService
+
+        now = datetime.utcnow()
+        # SKIP LOCKED lets several workers drain the outbox without sending
+        # the same message twice (ignored on SQLite)
+        messages = EmailOutbox.query.filter(
+            EmailOutbox.status == OutboxStatus.pending,
+            EmailOutbox.next_attempt_at <= now
+        ).order_by(
+            EmailOutbox.next_attempt_at, EmailOutbox.id
+        ).limit(batch_size).with_for_update(skip_locked=True).all()
+
+        if not messages:
+            db.session.rollback()
+            return 0, 0
+
+        results = EmailService.send_bulk(
+            [
+                {'to': message.recipient.split(','), 'subject': message.subject, 'template': message.html}
+                for message in messages
+            ],
+            batch_size=len(messages)
+        )
+
+        sent = failed = 0
+        for message, (_, ok, error) in zip(messages, results):
+            if ok:
+                message.status = OutboxStatus.sent
+                message.attempts += 1
+                message.sent_at = now
+                message.last_error = None
+                sent += 1
+            else:
+                EmailOutboxService._record_failure(message, error, now)
+                failed += 1
+
+        db.session.commit()
+        return sent, failed
+
+    @staticmethod
+    def _record_failure(message, error, now):
+        message.attempts += 1
+        message.last_error = error[:1000]
+        if message.attempts >= OUTBOX_MAX_ATTEMPTS:
+            message.status = OutboxStatus.failed
+        else:
+            delay = min(
+                OUTBOX_BASE_DELAY_SECONDS * 2 ** (message.attempts - 1),
+                OUTBOX_MAX_DELAY_SECONDS
+            )
+            message.next_attempt_at = now + timedelta(seconds=delay)
+
+    @staticmethod
+    def purge_sent(retention_days=OUTBOX_RETENTION_DAYS):
+        """Delete sent messages older than the retention window"""
+        cutoff = datetime.utcnow() - timedelta(days=retention_days)
+        count = EmailOutbox.query.filter(
+            EmailOutbox.status == OutboxStatus.sent,
+            EmailOutbox.sent_at < cutoff
+        ).delete(synchronize_session=False)
+        db.session.commit()
+        return count
@@ -3,168 +3,206 @@ Email Service for sending notifications
 Handles booking confirmations, cancellations, approvals, and reminders
 """
 
+import smtplib
+from collections import namedtuple
 from flask_mail import Message
-from flask import current_app, render_template_string
-from datetime import datetime
+from flask import current_app
+from models import db, Booking, User, Seat, Library
+
+# Messages sent per SMTP connection before reconnecting; most providers
+# cap how many messages one session may carry
+BULK_BATCH_SIZE = 50
+
+# Flat, pre-joined booking data the booking email templates render from
+BookingEmailRow = namedtuple('BookingEmailRow', [
+    'booking_id', 'date', 'time_slot', 'username', 'email', 'seat_number',
+    'library_name', 'library_slug', 'library_address', 'library_city',
+    'library_id', 'grace_period_minutes'
+])
+
+# kind -> (template, subject)
+BOOKING_EMAILS = {
+    'confirmation': ('email_booking_confirmation.html', 'Seat Booking Confirmation'),
+    'cancellation': ('email_booking_cancelled.html', 'Booking Cancelled'),
+    'reminder': ('email_booking_reminder.html', 'Reminder: Your booking is tomorrow'),
+}
+
+# Booking emails that carry a check-in QR code
+CHECKIN_QR_EMAILS = {'confirmation', 'reminder'}
 
 class EmailService:
     
+    @staticmethod
+    def build_message(to, subject, template):
+        """Build a Message with the site subject prefix and default sender"""
+        return Message(
+            subject=f"[{current_app.config.get('SITE_NAME', 'Kaluwala Libraries')}] {subject}",
+            recipients=[to] if isinstance(to, str) else to,
+            html=template,
+            sender=current_app.config.get('MAIL_DEFAULT_SENDER', 'noreply@kaluwala.com')
+        )
+    
     @staticmethod
     def send_email(to, subject, template):
         """Send email using template"""
         try:
             from app import mail
             
-            msg = Message(
-                subject=f"[{current_app.config.get('SITE_NAME', 'Kaluwala Libraries')}] {subject}",
-                recipients=[to] if isinstance(to, str) else to,
-                html=template,
-                sender=current_app.config.get('MAIL_DEFAULT_SENDER', 'noreply@kaluwala.com')
-            )
-            
-            mail.send(msg)
+            mail.send(EmailService.build_message(to, subject, template))
             return True
         except Exception as e:
             print(f"Email error: {str(e)}")
             return False
     
     @staticmethod
-    def send_booking_confirmation(booking):
-        """Send booking confirmation email"""
-        site_url = current_app.config.get('SITE_URL', 'http://localhost:5000')
-        
-        template = f"""
-        <!DOCTYPE html>
-        <html>
-        <head>
-            <style>
-                body {{ font-family: Arial, sans-serif; line-height: 1.6; color: #333; }}
-                .container {{ max-width: 600px; margin: 0 auto; padding: 20px; }}
-                .header {{ background: linear-gradient(135deg, #2d5016 0%, #4a7c2c 100%); color: white; padding: 30px; text-align: center; border-radius: 10px 10px 0 0; }}
-                .content {{ background: #f9fafb; padding: 30px; border-radius: 0 0 10px 10px; }}
-                .detail {{ background: white; padding: 15px; margin: 10px 0; border-left: 4px solid #10b981; border-radius: 5px; }}
-                .footer {{ text-align: center; margin-top: 20px; color: #666; font-size: 0.9em; }}
-                .button {{ display: inline-block; padding: 12px 24px; background: #10b981; color: white; text-decoration: none; border-radius: 5px; margin-top: 15px; }}
-            </style>
-        </head>
-        <body>
-            <div class="container">
-                <div class="header">
-                    <h1>🎉 Booking Confirmed!</h1>
-                </div>
-                <div class="content">
-                    <p>Dear {booking.user.username},</p>
-                    <p>Your seat booking has been confirmed. Here are the details:</p>
-                    
-                    <div class="detail">
-                        <strong>📚 Library:</strong> {booking.library.name}<br>
-                        <strong>💺 Seat Number:</strong> {booking.seat.number}<br>
-                        <strong>📅 Date:</strong> {booking.date.strftime('%A, %B %d, %Y')}<br>
-                        <strong>⏰ Time Slot:</strong> {booking.time_slot.strftime('%I:%M %p')}<br>
-                        <strong>📍 Location:</strong> {booking.library.address}, {booking.library.city}
-                    </div>
-                    
-                    <p><strong>Important Reminders:</strong></p>
-                    <ul>
-                        <li>Please arrive on time for your slot</li>
-                        <li>Carry a valid ID for verification</li>
-                        <li>Follow library rules and maintain silence</li>
-                        <li>Cancel if you cannot make it</li>
-                    </ul>
-                    
-                    <center>
-                        <a href="{site_url}/{booking.library.slug}/bookings" class="button">
-                            View My Bookings
-                        </a>
-                    </center>
-                    
-                    <div class="footer">
-                        <p>This is an automated message from Kaluwala CSR Libraries</p>
-                        <p>If you didn't make this booking, please contact us immediately.</p>
-                    </div>
-                </div>
-            </div>
-        </body>
-        </html>
+    def send_bulk(messages, batch_size=BULK_BATCH_SIZE):
         """
+        Send pre-rendered messages (dicts with to, subject and template),
+        reusing one SMTP connection per batch instead of one per message.
+        Returns a (recipient, ok, error) tuple per message, in input order.
+        """
+        from app import mail
         
-        return EmailService.send_email(
-            to=booking.user.email,
-            subject="Seat Booking Confirmation",
-            template=template
+        messages = list(messages)
+        results = []
+        for start in range(0, len(messages), batch_size):
+            batch = messages[start:start + batch_size]
+            try:
+                with mail.connect() as connection:
+                    for item in batch:
+                        try:
+                            connection.send(EmailService.build_message(
+                                item['to'], item['subject'], item['template']
+                            ))
+                        except (smtplib.SMTPServerDisconnected, ConnectionError):
+                            raise
+                        except Exception as e:
+                            # Rejected recipient or bad message; keep going
+                            results.append((item['to'], False, str(e) or type(e).__name__))
+                        else:
+                            results.append((item['to'], True, None))
+            except Exception as e:
+                # Could not connect, or the server dropped the connection:
+                # everything not yet attempted in this batch fails
+                for item in batch[len(results) - start:]:
+                    results.append((item['to'], False, str(e) or type(e).__name__))
+        
+        return results
+    
+    # ============= Rendering =============
+    
+    @staticmethod
+    def _template(name):
+        """Compiled template from the app's Jinja environment (cached after first load)"""
+        return current_app.jinja_env.get_template(name)
+    
+    @staticmethod
+    def booking_rows_query():
+        """
+        One joined query yielding BookingEmailRow-shaped tuples. Callers add
+        their own filters, e.g. .filter(Booking.date == day).
+        """
+        return db.session.query(
+            Booking.id, Booking.date, Booking.time_slot,
+            User.username, User.email, Seat.number,
+            Library.name, Library.slug, Library.address, Library.city,
+            Booking.library_id, Booking.grace_period_minutes
+        ).join(User, Booking.user_id == User.id
+        ).join(Seat, Booking.seat_id == Seat.id
+        ).join(Library, Booking.library_id == Library.id)
+    
+    @staticmethod
+    def booking_row(booking):
+        """BookingEmailRow for a single Booking object"""
+        return BookingEmailRow(
+            booking.id, booking.date, booking.time_slot,
+            booking.user.username, booking.user.email, booking.seat.number,
+            booking.library.name, booking.library.slug,
+            booking.library.address, booking.library.city,
+            booking.library_id, booking.grace_period_minutes
         )
     
     @staticmethod
-    def send_cancellation_email(booking):
-        """Send booking cancellation email"""
-        template = f"""
-        <!DOCTYPE html>
-        <html>
-        <head>
-            <style>
-                body {{ font-family: Arial, sans-serif; line-height: 1.6; color: #333; }}
-                .container {{ max-width: 600px; margin: 0 auto; padding: 20px; }}
-                .header {{ background: linear-gradient(135deg, #ef4444 0%, #dc2626 100%); color: white; padding: 30px; text-align: center; border-radius: 10px 10px 0 0; }}
-                .content {{ background: #f9fafb; padding: 30px; border-radius: 0 0 10px 10px; }}
-                .detail {{ background: white; padding: 15px; margin: 10px 0; border-left: 4px solid #ef4444; border-radius: 5px; }}
-            </style>
-        </head>
-        <body>
-            <div class="container">
-                <div class="header">
-                    <h1>❌ Booking Cancelled</h1>
-                </div>
-                <div class="content">
-                    <p>Dear {booking.user.username},</p>
-                    <p>Your booking has been cancelled:</p>
-                    
-                    <div class="detail">
-                        <strong>📚 Library:</strong> {booking.library.name}<br>
-                        <strong>💺 Seat:</strong> {booking.seat.number}<br>
-                        <strong>📅 Date:</strong> {booking.date.strftime('%B %d, %Y')}<br>
-                        <strong>⏰ Time:</strong> {booking.time_slot.strftime('%I:%M %p')}
-                    </div>
-                    
-                    <p>You can make a new booking anytime from our website.</p>
-                </div>
-            </div>
-        </body>
-        </html>
+    def render_booking_emails(kind, rows):
+        """
+        Render one booking email per row without touching the ORM. Rows are
+        BookingEmailRow tuples (or anything with the same fields, e.g. from
+        booking_rows_query). Returns message dicts for send_bulk/queue.
         """
+        from services.checkin_token import CheckinTokenService
         
-        return EmailService.send_email(
-            to=booking.user.email,
-            subject="Booking Cancelled",
-            template=template
+        template_name, subject = BOOKING_EMAILS[kind]
+        template = EmailService._template(template_name)
+        site_url = current_app.config.get('SITE_URL', 'http://localhost:5000')
+        
+        messages = []
+        for row in rows:
+            row = BookingEmailRow(*row)
+            checkin_token = None
+            if kind in CHECKIN_QR_EMAILS:
+                checkin_token = CheckinTokenService.issue_for_row(row)
+            messages.append({
+                'to': row.email,
+                'subject': subject,
+                'template': template.render(row=row, site_url=site_url, checkin_token=checkin_token)
+            })
+        return messages
+    
+    @staticmethod
+    def _booking_email(kind, booking):
+        return EmailService.render_booking_emails(kind, [EmailService.booking_row(booking)])[0]
+    
+    # ============= Outbox =============
+    
+    @staticmethod
+    def queue_email(to, subject, template):
+        """
+        Add an email to the outbox in the caller's transaction. It is sent by
+        the background sender once the caller commits.
+        """
+        from services.email_outbox import EmailOutboxService
+        return EmailOutboxService.enqueue(to, subject, template)
+    
+    @staticmethod
+    def queue_booking_confirmation(booking):
+        """Queue a booking confirmation email"""
+        return EmailService.queue_email(**EmailService._booking_email('confirmation', booking))
+    
+    @staticmethod
+    def queue_cancellation_email(booking):
+        """Queue a booking cancellation email"""
+        return EmailService.queue_email(**EmailService._booking_email('cancellation', booking))
+    
+    @staticmethod
+    def queue_booking_emails(kind, rows, send_at=None, spacing_seconds=0):
+        """Render and queue booking emails for many pre-joined rows at once"""
+        from services.email_outbox import EmailOutboxService
+        return EmailOutboxService.enqueue_many(
+            EmailService.render_booking_emails(kind, rows),
+            send_at=send_at,
+            spacing_seconds=spacing_seconds
         )
     
+    # ============= Direct sends =============
+    
+    @staticmethod
+    def send_booking_confirmation(booking):
+        """Send booking confirmation email"""
+        return EmailService.send_email(**EmailService._booking_email('confirmation', booking))
+    
+    @staticmethod
+    def send_cancellation_email(booking):
+        """Send booking cancellation email"""
+        return EmailService.send_email(**EmailService._booking_email('cancellation', booking))
+    
     @staticmethod
     def send_approval_email(user, library):
         """Send account approval email"""
-        site_url = current_app.config.get('SITE_URL', 'http://localhost:5000')
-        
-        template = f"""
-        <!DOCTYPE html>
-        <html>
-        <body style="font-family: Arial, sans-serif;">
-            <div style="max-width: 600px; margin: 0 auto; padding: 20px;">
-                <div style="background: linear-gradient(135deg, #10b981 0%, #059669 100%); color: white; padding: 30px; text-align: center; border-radius: 10px 10px 0 0;">
-                    <h1>✅ Account Approved!</h1>
-                </div>
-                <div style="background: #f9fafb; padding: 30px; border-radius: 0 0 10px 10px;">
-                    <p>Dear {user.username},</p>
-                    <p>Great news! Your account has been approved by {library.name} administration.</p>
-                    <p>You can now login and start booking library seats.</p>
-                    <center>
-                        <a href="{site_url}/login" style="display: inline-block; padding: 12px 24px; background: #10b981; color: white; text-decoration: none; border-radius: 5px; margin-top: 15px;">
-                            Login Now
-                        </a>
-                    </center>
-                </div>
-            </div>
-        </body>
-        </html>
-        """
+        template = EmailService._template('email_account_approved.html').render(
+            username=user.username,
+            library_name=library.name,
+            site_url=current_app.config.get('SITE_URL', 'http://localhost:5000')
+        )
         
         return EmailService.send_email(
             to=user.email,
@@ -175,28 +213,4 @@ class EmailService:
     @staticmethod
     def send_reminder_email(booking):
         """Send booking reminder (1 day before)"""
-        template = f"""
-        <!DOCTYPE html>
-        <html>
-        <body style="font-family: Arial, sans-serif;">
-            <div style="max-width: 600px; margin: 0 auto; padding: 20px;">
-                <h2>🔔 Booking Reminder</h2>
-                <p>Dear {booking.user.username},</p>
-                <p>This is a reminder about your upcoming booking:</p>
-                <div style="background: #fef3c7; padding: 15px; border-left: 4px solid #f59e0b; margin: 15px 0;">
-                    <strong>Tomorrow:</strong> {booking.date.strftime('%B %d, %Y')}<br>
-                    <strong>Time:</strong> {booking.time_slot.strftime('%I:%M %p')}<br>
-                    <strong>Seat:</strong> {booking.seat.number}<br>
-                    <strong>Library:</strong> {booking.library.name}
-                </div>
-                <p>Please arrive on time!</p>
-            </div>
-        </body>
-        </html>
-        """
-        
-        return EmailService.send_email(
-            to=booking.user.email,
-            subject="Reminder: Your booking is tomorrow",
-            template=template
-        )
+        return EmailService.send_email(**EmailService._booking_email('reminder', booking))
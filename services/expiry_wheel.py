@@ -0,0 +1,178 @@
+"""
+No-Show Expiry Wheel
+In-process timer wheel that auto-cancels each booking when its grace period ends
+"""
+
+import os
+import threading
+from datetime import date, datetime, time, timedelta
+from models import db, Booking, BookingStatus
+
+# A booking expires once the clock is strictly past slot start + grace
+# period, so each bucket fires one second after its deadline
+FIRE_DELAY = timedelta(seconds=1)
+
+# How often each wheel reloads from the database, picking up bookings made
+# by the web processes and changes made by other workers
+WHEEL_REFRESH_INTERVAL = timedelta(seconds=60)
+
+# Pause after a failed tick (e.g. database unavailable) before retrying
+ERROR_RETRY_SECONDS = 10
+
+
+class NoShowExpiryWheel:
+    """
+    Today's unreported bookings bucketed by expiry time. A background thread
+    sleeps until the earliest bucket is due and cancels only the bookings in
+    it. The wheel runs in each worker process, and its thread reloads it
+    from the database at start, every minute and at midnight. schedule() and
+    discard() update it directly when it runs in the calling process and
+    are no-ops otherwise.
+    """
+
+    _lock = threading.Lock()
+    _wakeup = threading.Event()
+    _buckets = {}      # fire_at (datetime) -> set of booking IDs
+    _deadlines = {}    # booking_id -> fire_at
+    _day = None        # date the wheel currently holds
+    _loaded_at = None  # when load_today() last ran
+    _app = None
+    _pid = None
+
+    # ============= Lifecycle =============
+
+    @staticmethod
+    def start(app):
+        """Start the expiry thread for this process (idempotent per process)"""
+        NoShowExpiryWheel._app = app
+        NoShowExpiryWheel._ensure_running()
+
+    @staticmethod
+    def _ensure_running():
+        app = NoShowExpiryWheel._app
+        if app is None or NoShowExpiryWheel._pid == os.getpid():
+            return
+        # First start, or a forked worker (gunicorn preload_app) whose copy
+        # of the parent's thread is gone: start afresh with clean state
+        NoShowExpiryWheel._pid = os.getpid()
+        NoShowExpiryWheel._lock = threading.Lock()
+        NoShowExpiryWheel._wakeup = threading.Event()
+        NoShowExpiryWheel._buckets = {}
+        NoShowExpiryWheel._deadlines = {}
+        NoShowExpiryWheel._day = None
+        NoShowExpiryWheel._loaded_at = None
+        thread = threading.Thread(
+            target=NoShowExpiryWheel._run, args=(app,),
+            name='no-show-expiry', daemon=True
+        )
+        thread.start()
+
+    @staticmethod
+    def _run(app):
+        while True:
+            try:
+                ids = NoShowExpiryWheel._tick(app)
+                if ids:
+                    with app.app_context():
+                        from services.reporting_service import ReportingService
+                        count = ReportingService.auto_cancel_expired_bookings(booking_ids=ids)
+                        if count > 0:
+                            print(f"🔄 Auto-cancelled {count} no-show booking(s)")
+            except Exception as e:
+                print(f"⚠️ No-show expiry error: {e}")
+                NoShowExpiryWheel._wakeup.wait(ERROR_RETRY_SECONDS)
+
+            NoShowExpiryWheel._wakeup.wait(NoShowExpiryWheel._seconds_until_next())
+            NoShowExpiryWheel._wakeup.clear()
+
+    @staticmethod
+    def _tick(app):
+        """Reload when due or on a new day, then pop and return the IDs of all due buckets"""
+        now = datetime.now()
+        loaded_at = NoShowExpiryWheel._loaded_at
+        if NoShowExpiryWheel._day != now.date() or loaded_at is None or \
+                now - loaded_at >= WHEEL_REFRESH_INTERVAL:
+            with app.app_context():
+                NoShowExpiryWheel.load_today()
+
+        now = datetime.now()
+        due = set()
+        with NoShowExpiryWheel._lock:
+            for fire_at in [key for key in NoShowExpiryWheel._buckets if key <= now]:
+                for booking_id in NoShowExpiryWheel._buckets.pop(fire_at):
+                    NoShowExpiryWheel._deadlines.pop(booking_id, None)
+                    due.add(booking_id)
+        return due
+
+    @staticmethod
+    def _seconds_until_next():
+        now = datetime.now()
+        midnight = datetime.combine(date.today() + timedelta(days=1), time())
+        with NoShowExpiryWheel._lock:
+            next_fire = min(NoShowExpiryWheel._buckets, default=midnight)
+        if NoShowExpiryWheel._loaded_at is not None:
+            next_fire = min(next_fire, NoShowExpiryWheel._loaded_at + WHEEL_REFRESH_INTERVAL)
+        return max(0.0, (min(next_fire, midnight) - now).total_seconds())
+
+    @staticmethod
+    def load_today():
+        """Rebuild the wheel from today's unreported active bookings"""
+        loaded_at = datetime.now()
+        today = loaded_at.date()
+        rows = db.session.query(
+            Booking.id, Booking.time_slot, Booking.grace_period_minutes
+        ).filter(
+            Booking.date == today,
+            Booking.status == BookingStatus.booked,
+            Booking.is_reported == False
+        ).all()
+
+        with NoShowExpiryWheel._lock:
+            NoShowExpiryWheel._buckets = {}
+            NoShowExpiryWheel._deadlines = {}
+            NoShowExpiryWheel._day = today
+            NoShowExpiryWheel._loaded_at = loaded_at
+            for booking_id, time_slot, grace_minutes in rows:
+                NoShowExpiryWheel._add(booking_id, today, time_slot, grace_minutes)
+        # Let the thread recompute how long to sleep
+        NoShowExpiryWheel._wakeup.set()
+
+    # ============= Updates (call after commit) =============
+
+    @staticmethod
+    def _add(booking_id, day, time_slot, grace_minutes):
+        """Insert a booking into its bucket (caller holds the lock)"""
+        fire_at = datetime.combine(day, time_slot) + timedelta(minutes=grace_minutes) + FIRE_DELAY
+        NoShowExpiryWheel._buckets.setdefault(fire_at, set()).add(booking_id)
+        NoShowExpiryWheel._deadlines[booking_id] = fire_at
+
+    @staticmethod
+    def schedule(booking):
+        """Track a new booking; only today's bookings enter the wheel"""
+        NoShowExpiryWheel._ensure_running()
+        if booking.date != NoShowExpiryWheel._day:
+            return
+        with NoShowExpiryWheel._lock:
+            NoShowExpiryWheel._add(
+                booking.id, booking.date, booking.time_slot, booking.grace_period_minutes
+            )
+        # The new deadline may be earlier than the one the thread sleeps on
+        NoShowExpiryWheel._wakeup.set()
+
+    @staticmethod
+    def discard(booking_id):
+        """Stop tracking a booking that was cancelled or checked in"""
+        with NoShowExpiryWheel._lock:
+            fire_at = NoShowExpiryWheel._deadlines.pop(booking_id, None)
+            if fire_at is not None:
+                bucket = NoShowExpiryWheel._buckets.get(fire_at)
+                if bucket is not None:
+                    bucket.discard(booking_id)
+                    if not bucket:
+                        del NoShowExpiryWheel._buckets[fire_at]
+
+    @staticmethod
+    def discard_many(booking_ids):
+        """discard() for a batch of bookings"""
+        for booking_id in booking_ids:
+            NoShowExpiryWheel.discard(booking_id)
@@ -0,0 +1,261 @@
+"""
+Job Runner
+Durable, database-backed background jobs executed by the standalone worker
+"""
+
+import json
+import time as clock
+from datetime import datetime, timedelta
+from sqlalchemy import and_, or_, text
+from sqlalchemy.exc import IntegrityError
+from models import db, BackgroundJob, JobRun, JobStatus
+
+# How often an idle worker checks for due jobs
+JOB_POLL_SECONDS = 2
+
+# Without advisory locks (SQLite) a job stuck in 'running' this long is
+# assumed to belong to a dead worker and may be claimed again
+JOB_STALE_SECONDS = 3600
+
+# One-off jobs are retried with exponential backoff, then marked failed
+JOB_MAX_ATTEMPTS = 5
+JOB_RETRY_BASE_SECONDS = 30
+
+JOB_RUN_RETENTION_DAYS = 7
+
+# First key of the two-key PostgreSQL advisory lock; the second is the job ID
+JOB_LOCK_CLASS = 0x6A6F62
+
+
+class JobRunner:
+    """Register job handlers, queue jobs and run whatever is due"""
+
+    _handlers = {}  # name -> callable taking the job's payload as kwargs
+
+    # ============= Definition =============
+
+    @staticmethod
+    def register(name, handler):
+        """Make a handler available to the worker under a job name"""
+        JobRunner._handlers[name] = handler
+
+    @staticmethod
+    def ensure_recurring(name, interval_seconds):
+        """Create (or retime) the schedule row of a recurring job"""
+        job = BackgroundJob.query.filter(
+            BackgroundJob.name == name,
+            BackgroundJob.interval_seconds.isnot(None)
+        ).first()
+        if job is None:
+            db.session.add(BackgroundJob(
+                name=name,
+                interval_seconds=interval_seconds,
+                status=JobStatus.pending,
+                run_at=datetime.utcnow()
+            ))
+        elif job.interval_seconds != interval_seconds:
+            job.interval_seconds = interval_seconds
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # Another worker created it at the same moment
+            db.session.rollback()
+
+    @staticmethod
+    def drop_recurring(name):
+        """Delete the schedule row of a recurring job that no longer exists"""
+        BackgroundJob.query.filter(
+            BackgroundJob.name == name,
+            BackgroundJob.interval_seconds.isnot(None)
+        ).delete(synchronize_session=False)
+        db.session.commit()
+
+    @staticmethod
+    def enqueue(name, run_at=None, **payload):
+        """
+        Queue a one-off job in the caller's transaction; it runs once the
+        caller commits. Payload values must be JSON-serialisable.
+        """
+        job = BackgroundJob(
+            name=name,
+            payload=json.dumps(payload) if payload else None,
+            status=JobStatus.pending,
+            run_at=run_at or datetime.utcnow()
+        )
+        db.session.add(job)
+        return job
+
+    # ============= Execution =============
+
+    @staticmethod
+    def run_forever(poll_seconds=JOB_POLL_SECONDS):
+        """Worker main loop (call inside an app context)"""
+        use_locks = db.engine.dialect.name == 'postgresql'
+        lock_conn = None
+
+        while True:
+            try:
+                if use_locks and lock_conn is None:
+                    # Session-level advisory locks live on this dedicated
+                    # connection, so a crashed worker releases its locks
+                    # when the connection drops
+                    lock_conn = db.engine.connect().execution_options(isolation_level='AUTOCOMMIT')
+                ran = JobRunner.run_due(lock_conn)
+            except Exception as e:
+                print(f"⚠️ Job runner error: {e}")
+                db.session.rollback()
+                if lock_conn is not None:
+                    # The connection may be dead (database restart, failover,
+                    # idle timeout) and is held outside the pool, so nothing
+                    # else would replace it. Discard it rather than return it
+                    # to the pool, which also drops any advisory locks it
+                    # holds, and open a new one on the next pass.
+                    try:
+                        lock_conn.invalidate()
+                        lock_conn.close()
+                    except Exception:
+                        pass
+                    lock_conn = None
+                ran = 0
+            finally:
+                db.session.remove()
+
+            if not ran:
+                clock.sleep(poll_seconds)
+
+    @staticmethod
+    def run_due(lock_conn=None, limit=20):
+        """Claim and run due jobs one after another. Returns how many ran"""
+        now = datetime.utcnow()
+        due_ids = [
+            job_id for (job_id,) in db.session.query(BackgroundJob.id).filter(
+                BackgroundJob.status.in_([JobStatus.pending, JobStatus.running]),
+                BackgroundJob.run_at <= now
+            ).order_by(BackgroundJob.run_at).limit(limit).all()
+        ]
+        db.session.commit()
+
+        ran = 0
+        for job_id in due_ids:
+            if not JobRunner._claim(job_id, lock_conn):
+                continue
+            try:
+                JobRunner._execute(job_id)
+            finally:
+                if lock_conn is not None:
+                    lock_conn.execute(
+                        text('SELECT pg_advisory_unlock(:cls, :id)'),
+                        {'cls': JOB_LOCK_CLASS, 'id': job_id}
+                    )
+            ran += 1
+        return ran
+
+    @staticmethod
+    def _claim(job_id, lock_conn):
+        """Mark a job running if this worker may run it"""
+        now = datetime.utcnow()
+        if lock_conn is not None:
+            acquired = lock_conn.execute(
+                text('SELECT pg_try_advisory_lock(:cls, :id)'),
+                {'cls': JOB_LOCK_CLASS, 'id': job_id}
+            ).scalar()
+            if not acquired:
+                return False
+            # Holding the lock proves nobody else is running it, so a row
+            # left 'running' by a crashed worker can be taken over
+            claimable = BackgroundJob.status.in_([JobStatus.pending, JobStatus.running])
+        else:
+            claimable = or_(
+                BackgroundJob.status == JobStatus.pending,
+                and_(
+                    BackgroundJob.status == JobStatus.running,
+                    BackgroundJob.started_at < now - timedelta(seconds=JOB_STALE_SECONDS)
+                )
+            )
+
+        claimed = db.session.execute(
+            db.update(BackgroundJob).where(
+                BackgroundJob.id == job_id,
+                BackgroundJob.run_at <= now,
+                claimable
+            ).values(
+                status=JobStatus.running,
+                started_at=now,
+                attempts=BackgroundJob.attempts + 1
+            )
+        ).rowcount
+        db.session.commit()
+
+        if not claimed and lock_conn is not None:
+            lock_conn.execute(
+                text('SELECT pg_advisory_unlock(:cls, :id)'),
+                {'cls': JOB_LOCK_CLASS, 'id': job_id}
+            )
+        return claimed == 1
+
+    @staticmethod
+    def _execute(job_id):
+        """Run a claimed job, then reschedule it and record the run"""
+        job = db.session.get(BackgroundJob, job_id)
+        name = job.name
+        payload = json.loads(job.payload) if job.payload else {}
+        started_at = datetime.utcnow()
+        started = clock.monotonic()
+
+        error = None
+        try:
+            handler = JobRunner._handlers.get(name)
+            if handler is None:
+                raise LookupError(f"No handler registered for job '{name}'")
+            handler(**payload)
+        except Exception as e:
+            db.session.rollback()
+            error = f"{type(e).__name__}: {e}"
+            print(f"⚠️ Job {name} failed: {error}")
+
+        duration_ms = int((clock.monotonic() - started) * 1000)
+        finished_at = datetime.utcnow()
+
+        job = db.session.get(BackgroundJob, job_id)
+        job.finished_at = finished_at
+        job.last_duration_ms = duration_ms
+        job.last_error = error
+
+        if job.interval_seconds:
+            # Fixed-rate schedule, but never queue up missed runs
+            job.status = JobStatus.pending
+            job.run_at = max(started_at + timedelta(seconds=job.interval_seconds), finished_at)
+            job.attempts = 0
+        elif error is None:
+            job.status = JobStatus.done
+        elif job.attempts >= JOB_MAX_ATTEMPTS:
+            job.status = JobStatus.failed
+        else:
+            job.status = JobStatus.pending
+            job.run_at = finished_at + timedelta(
+                seconds=JOB_RETRY_BASE_SECONDS * 2 ** (job.attempts - 1)
+            )
+
+        db.session.add(JobRun(
+            job_id=job_id,
+            job_name=name,
+            started_at=started_at,
+            duration_ms=duration_ms,
+            succeeded=error is None,
+            error=error
+        ))
+        db.session.commit()
+
+    # ============= Housekeeping =============
+
+    @staticmethod
+    def purge_history(retention_days=JOB_RUN_RETENTION_DAYS):
+        """Delete old run records and finished one-off jobs"""
+        cutoff = datetime.utcnow() - timedelta(days=retention_days)
+        JobRun.query.filter(JobRun.started_at < cutoff).delete(synchronize_session=False)
+        BackgroundJob.query.filter(
+            BackgroundJob.interval_seconds.is_(None),
+            BackgroundJob.status.in_([JobStatus.done, JobStatus.failed]),
+            BackgroundJob.finished_at < cutoff
+        ).delete(synchronize_session=False)
+        db.session.commit()
@@ -0,0 +1,75 @@
+"""
+Library Cache
+Process-local slug/ID -> Library lookup shared by request routing and admin views
+"""
+
+import threading
+from models import db, Library
+from services.cache import TTLCache, MISSING
+
+# Unknown slugs are remembered for less time so a library created in
+# another worker becomes reachable quickly.
+LIBRARY_TTL_SECONDS = 300
+MISSING_SLUG_TTL_SECONDS = 30
+
+
+class LibraryCache:
+    """Versioned cache of detached Library rows keyed by slug or ('id', library_id)"""
+
+    _cache = TTLCache(ttl=LIBRARY_TTL_SECONDS, maxsize=512)
+    _version = 0
+    _lock = threading.Lock()
+
+    @staticmethod
+    def get_by_slug(slug):
+        """
+        Return the Library for a slug bound to the current session, or None.
+        Cache hits are merged without a query; relationships still lazy-load.
+        """
+        cached = LibraryCache._cache.get(slug)
+        if cached is MISSING:
+            version = LibraryCache._version
+            library = Library.query.filter_by(slug=slug).first()
+            if library is not None:
+                # Keep a detached copy so later commits in this request
+                # cannot expire the cached instance
+                db.session.expunge(library)
+            LibraryCache._store(slug, library, version)
+            cached = library
+
+        if cached is None:
+            return None
+        return db.session.merge(cached, load=False)
+
+    @staticmethod
+    def get_by_id(library_id):
+        """get_by_slug() for a library ID"""
+        key = ('id', library_id)
+        cached = LibraryCache._cache.get(key)
+        if cached is MISSING:
+            version = LibraryCache._version
+            library = db.session.get(Library, library_id)
+            if library is not None:
+                db.session.expunge(library)
+            LibraryCache._store(key, library, version)
+            cached = library
+
+        if cached is None:
+            return None
+        return db.session.merge(cached, load=False)
+
+    @staticmethod
+    def _store(key, library, version):
+        with LibraryCache._lock:
+            # Skip the write if an invalidation raced with our query
+            if version != LibraryCache._version:
+                return
+            ttl = LIBRARY_TTL_SECONDS if library is not None else MISSING_SLUG_TTL_SECONDS
+            LibraryCache._cache.set(key, library, ttl=ttl)
+
+    @staticmethod
+    def invalidate():
+        """Drop every cached library; call after libraries are created, edited or deleted"""
+        with LibraryCache._lock:
+            LibraryCache._version += 1
+            LibraryCache._cache.clear()
@@ -0,0 +1,62 @@
+"""
+Reminder Service
+Day-before booking reminders, queued in batches through the email outbox
+"""
+
+from datetime import date, datetime, timedelta
+from models import db, Booking, BookingStatus
+from services.email_service import EmailService
+
+REMINDER_BATCH_SIZE = 500
+REMINDER_MAX_PER_RUN = 5000
+
+# Queued reminders are given staggered send times so the outbox delivers
+# them at no more than this rate
+REMINDER_RATE_PER_MINUTE = 120
+
+
+class ReminderService:
+
+    @staticmethod
+    def queue_day_before_reminders(day=None, batch_size=REMINDER_BATCH_SIZE, max_per_run=REMINDER_MAX_PER_RUN):
+        """
+        Queue reminders for active bookings on `day` (default tomorrow) that
+        have not been reminded yet. Each batch is one joined SELECT, one
+        UPDATE that claims the rows and one INSERT into the outbox, committed
+        together. Returns the number of reminders queued.
+        """
+        day = day or date.today() + timedelta(days=1)
+        spacing = 60.0 / REMINDER_RATE_PER_MINUTE
+        send_at = datetime.utcnow()
+        queued = 0
+
+        while queued < max_per_run:
+            rows = EmailService.booking_rows_query().filter(
+                Booking.date == day,
+                Booking.status == BookingStatus.booked,
+                Booking.reminder_sent_at.is_(None)
+            ).order_by(Booking.id).limit(min(batch_size, max_per_run - queued)).all()
+
+            if not rows:
+                break
+
+            # Claim the rows; anything another run claimed first is skipped
+            claimed = set(db.session.execute(
+                db.update(Booking).where(
+                    Booking.id.in_([row.id for row in rows]),
+                    Booking.reminder_sent_at.is_(None)
+                ).values(
+                    reminder_sent_at=datetime.utcnow()
+                ).returning(Booking.id)
+            ).scalars())
+            rows = [row for row in rows if row.id in claimed]
+
+            EmailService.queue_booking_emails(
+                'reminder', rows, send_at=send_at, spacing_seconds=spacing
+            )
+            db.session.commit()
+
+            send_at += timedelta(seconds=len(rows) * spacing)
+            queued += len(rows)
+
+        return queued
@@ -3,8 +3,25 @@ Reporting Service
 Handles user check-in and auto-cancellation for no-shows
 """
 
-from datetime import datetime, timedelta
-from models import db, Booking, BookingStatus, NoShowHistory
+from collections import namedtuple
+from datetime import datetime, time, timedelta
+from sqlalchemy import extract, literal, or_
+from models import db, Booking, BookingStatus, NoShowHistory, Seat, User
+from services.availability_service import AvailabilityService
+from services.expiry_wheel import NoShowExpiryWheel
+from services.checkin_hub import CheckinHub
+from services.booking_rollup import BookingRollupService
+from services.analytics_cache import AnalyticsCache
+
+# Flat rows for the front-desk reporting page
+DeskRow = namedtuple('DeskRow', [
+    'booking_id', 'username', 'seat_number', 'time_slot',
+    'grace_period_minutes', 'reported_at'
+])
+PendingReport = namedtuple('PendingReport', [
+    'booking_id', 'username', 'seat_number', 'time_slot', 'slot_start', 'grace_end',
+    'minutes_remaining', 'grace_expired', 'can_report'
+])
 
 class ReportingService:
     
@@ -32,93 +49,307 @@ class ReportingService:
         booking.reported_by_admin = admin_user_id
         
         db.session.commit()
+        NoShowExpiryWheel.discard(booking.id)
+        CheckinHub.booking_reported(
+            booking.library_id, booking.id, booking.user.username,
+            booking.seat.number, booking.time_slot, booking.reported_at
+        )
         
         return True, "User marked as reported successfully"
+
+    @staticmethod
+    def mark_reported_by_token(token, library_id, admin_user_id):
+        """
+        Kiosk check-in from a scanned QR token. The token is verified without
+        a lookup and the booking is marked with one conditional UPDATE; the
+        database is only read again to explain a refusal.
+        Returns (success, message, claims).
+        """
+        from services.checkin_token import CheckinTokenService
+
+        claims, error = CheckinTokenService.verify(token)
+        if error:
+            return False, error, None
+        if claims.library_id != library_id:
+            return False, "This booking is for a different library", claims
+
+        error = CheckinTokenService.check_window(claims)
+        if error:
+            return False, error, claims
+
+        reported_at = datetime.now()
+        updated = db.session.execute(
+            db.update(Booking).where(
+                Booking.id == claims.booking_id,
+                Booking.library_id == library_id,
+                Booking.date == claims.slot_start.date(),
+                Booking.time_slot == claims.slot_start.time(),
+                Booking.status == BookingStatus.booked,
+                Booking.is_reported == False
+            ).values(
+                is_reported=True,
+                reported_at=reported_at,
+                reported_by_admin=admin_user_id
+            )
+        ).rowcount
+        db.session.commit()
+
+        if not updated:
+            booking = db.session.get(Booking, claims.booking_id)
+            if booking is not None and booking.is_reported:
+                return False, "Already checked in", claims
+            return False, "Booking is not active", claims
+
+        NoShowExpiryWheel.discard(claims.booking_id)
+        if CheckinHub.has_subscribers(library_id):
+            username = db.session.query(User.username).join(
+                Booking, Booking.user_id == User.id
+            ).filter(Booking.id == claims.booking_id).scalar()
+            CheckinHub.booking_reported(
+                library_id, claims.booking_id, username,
+                claims.seat_number, claims.slot_start.time(), reported_at
+            )
+
+        return True, "Checked in", claims
+
+    @staticmethod
+    def bulk_mark_reported(library_id, admin_user_id, booking_ids=(), seat_numbers=()):
+        """
+        Mark many of today's bookings reported at once, by booking ID or by
+        seat number (the seat's earliest booking still inside its grace
+        period). One SELECT resolves every item and checks grace windows in
+        SQL, then one UPDATE marks all valid bookings.
+        Returns a result dict per requested item, in request order.
+        """
+        booking_ids = [int(booking_id) for booking_id in booking_ids]
+        seat_numbers = [str(number).strip() for number in seat_numbers if str(number).strip()]
+        if not booking_ids and not seat_numbers:
+            return []
+        
+        now = datetime.now()
+        rows = db.session.query(
+            Booking.id, Seat.number, User.username, Booking.time_slot,
+            Booking.status, Booking.is_reported,
+            (ReportingService._grace_end_seconds() >= ReportingService._seconds_since_midnight(now)).label('in_grace')
+        ).join(Seat, Booking.seat_id == Seat.id
+        ).join(User, Booking.user_id == User.id
+        ).filter(
+            Booking.library_id == library_id,
+            Booking.date == now.date(),
+            or_(Booking.id.in_(booking_ids), Seat.number.in_(seat_numbers))
+        ).order_by(Booking.time_slot).all()
+        
+        by_id = {row.id: row for row in rows}
+        by_seat = {}
+        for row in rows:
+            by_seat.setdefault(row.number, []).append(row)
+        
+        def reportable(row):
+            return row.status == BookingStatus.booked and not row.is_reported and row.in_grace
+        
+        # Resolve each item to a booking row, or explain why it can't be
+        items = []
+        for booking_id in booking_ids:
+            row = by_id.get(booking_id)
+            items.append((booking_id, row, None if row else "Booking not found for today"))
+        for number in seat_numbers:
+            candidates = by_seat.get(number, [])
+            row = next((row for row in candidates if reportable(row)), None)
+            if row is None:
+                # Report on the most relevant booking: unreported first
+                active = [row for row in candidates if row.status == BookingStatus.booked]
+                row = next((row for row in active if not row.is_reported), active[0] if active else None)
+            items.append((number, row, None if row else "No active booking on this seat today"))
+        
+        to_mark = {row.id for _, row, _ in items if row is not None and reportable(row)}
+        marked = set()
+        if to_mark:
+            # Re-check every condition so concurrent check-ins and
+            # cancellations are never overwritten
+            marked = set(db.session.execute(
+                db.update(Booking).where(
+                    Booking.id.in_(to_mark),
+                    Booking.status == BookingStatus.booked,
+                    Booking.is_reported == False,
+                    ReportingService._grace_end_seconds() >= ReportingService._seconds_since_midnight(now)
+                ).values(
+                    is_reported=True,
+                    reported_at=now,
+                    reported_by_admin=admin_user_id
+                ).returning(Booking.id)
+            ).scalars())
+            db.session.commit()
+        
+        results = []
+        for item, row, error in items:
+            if row is None:
+                success, message = False, error
+            elif row.id in marked:
+                success, message = True, "Marked as reported"
+            elif row.status != BookingStatus.booked:
+                success, message = False, "Booking is not active"
+            elif row.is_reported:
+                success, message = False, "User already reported"
+            elif row.id in to_mark:
+                # Checked in or cancelled by someone else in the meantime
+                success, message = False, "Booking changed, please refresh"
+            else:
+                success, message = False, "Grace period expired. Booking should be auto-cancelled."
+            results.append({
+                'item': item,
+                'booking_id': row.id if row else None,
+                'seat_number': row.number if row else None,
+                'success': success,
+                'message': message
+            })
+        
+        NoShowExpiryWheel.discard_many(marked)
+        for row in rows:
+            if row.id in marked:
+                CheckinHub.booking_reported(
+                    library_id, row.id, row.username, row.number, row.time_slot, now
+                )
+        
+        return results
     
     @staticmethod
-    def auto_cancel_expired_bookings(library_id=None):
-        """Auto-cancel bookings where user didn't report within grace period"""
+    def _grace_end_seconds():
+        """SQL expression: seconds since midnight at which a booking's grace period ends"""
+        # Compared as seconds since midnight, which works on every backend
+        return (
+            extract('hour', Booking.time_slot) * 3600 +
+            extract('minute', Booking.time_slot) * 60 +
+            Booking.grace_period_minutes * 60
+        )
+    
+    @staticmethod
+    def _seconds_since_midnight(moment):
+        return moment.hour * 3600 + moment.minute * 60 + moment.second
+    
+    @staticmethod
+    def auto_cancel_expired_bookings(library_id=None, booking_ids=None):
+        """
+        Auto-cancel bookings where user didn't report within grace period.
+        Runs as one UPDATE ... RETURNING plus one INSERT ... SELECT into
+        no_show_history, whatever the number of bookings. booking_ids limits
+        the run to specific bookings (used by the expiry wheel).
+        """
         from datetime import date
         
-        # Query for today's bookings that should be cancelled
-        query = Booking.query.filter(
+        now = datetime.now()
+        
+        conditions = [
             Booking.status == BookingStatus.booked,
             Booking.is_reported == False,
-            Booking.date == date.today()
-        )
-        
+            Booking.date == date.today(),
+            ReportingService._grace_end_seconds() < ReportingService._seconds_since_midnight(now)
+        ]
         if library_id:
-            query = query.filter_by(library_id=library_id)
+            conditions.append(Booking.library_id == library_id)
+        if booking_ids is not None:
+            conditions.append(Booking.id.in_(list(booking_ids)))
+        
+        cancelled = db.session.execute(
+            db.update(Booking).where(*conditions).values(
+                status=BookingStatus.cancelled,
+                no_show=True,
+                auto_cancelled_at=now,
+                cancellation_reason="No-show: User did not report within 15 minutes"
+            ).returning(
+                Booking.id, Booking.library_id, Booking.date,
+                Booking.seat_id, Booking.time_slot
+            )
+        ).all()
+        
+        if not cancelled:
+            db.session.rollback()
+            return 0
         
-        bookings = query.all()
-        
-        cancelled_count = 0
-        
-        for booking in bookings:
-            if booking.should_auto_cancel():
-                # Auto-cancel the booking
-                booking.status = BookingStatus.cancelled
-                booking.no_show = True
-                booking.auto_cancelled_at = datetime.now()
-                booking.cancellation_reason = "No-show: User did not report within 15 minutes"
-                
-                # Record no-show in history
-                no_show = NoShowHistory(
-                    user_id=booking.user_id,
-                    library_id=booking.library_id,
-                    booking_id=booking.id,
-                    booking_date=booking.date,
-                    booking_time=booking.time_slot,
-                    seat_number=booking.seat.number
+        # Record no-shows in history, taking seat numbers from a join
+        db.session.execute(
+            db.insert(NoShowHistory).from_select(
+                ['user_id', 'library_id', 'booking_id', 'booking_date',
+                 'booking_time', 'seat_number', 'no_show_recorded_at'],
+                db.select(
+                    Booking.user_id, Booking.library_id, Booking.id, Booking.date,
+                    Booking.time_slot, Seat.number, literal(datetime.utcnow())
+                ).join(
+                    Seat, Booking.seat_id == Seat.id
+                ).where(
+                    Booking.id.in_([row.id for row in cancelled])
                 )
-                
-                db.session.add(no_show)
-                cancelled_count += 1
+            )
+        )
+        BookingRollupService.bookings_transitioned(
+            [row.id for row in cancelled], BookingStatus.booked, BookingStatus.cancelled
+        )
         
         db.session.commit()
         
-        return cancelled_count
+        by_library = {}
+        for row in cancelled:
+            AvailabilityService.mark_free(row.library_id, row.date, row.seat_id, row.time_slot)
+            by_library.setdefault(row.library_id, []).append(row.id)
+        NoShowExpiryWheel.discard_many(row.id for row in cancelled)
+        for cancelled_library_id, ids in by_library.items():
+            CheckinHub.bookings_cancelled(cancelled_library_id, ids, reason='no_show')
+        AnalyticsCache.invalidate()
+        
+        return len(cancelled)
     
     @staticmethod
-    def get_pending_reports(library_id):
-        """Get all bookings waiting for user to report"""
+    def _desk_query(library_id):
+        """Today's bookings for a library joined to user and seat, as flat rows"""
         from datetime import date
         
-        bookings = Booking.query.filter(
+        return db.session.query(
+            Booking.id, User.username, Seat.number, Booking.time_slot,
+            Booking.grace_period_minutes, Booking.reported_at
+        ).join(
+            User, Booking.user_id == User.id
+        ).join(
+            Seat, Booking.seat_id == Seat.id
+        ).filter(
             Booking.library_id == library_id,
-            Booking.date == date.today(),
+            Booking.date == date.today()
+        )
+    
+    @staticmethod
+    def get_pending_reports(library_id):
+        """Get all bookings waiting for user to report, as PendingReport tuples"""
+        from datetime import date
+        
+        rows = ReportingService._desk_query(library_id).filter(
             Booking.status == BookingStatus.booked,
             Booking.is_reported == False
         ).order_by(Booking.time_slot.asc()).all()
         
         # Add time remaining for each
+        today = date.today()
+        now = datetime.now()
         results = []
-        for booking in bookings:
-            booking_datetime = datetime.combine(booking.date, booking.time_slot)
-            grace_end = booking_datetime + timedelta(minutes=booking.grace_period_minutes)
-            
-            time_remaining = grace_end - datetime.now()
-            minutes_remaining = int(time_remaining.total_seconds() / 60)
+        for booking_id, username, seat_number, time_slot, grace_minutes, _ in rows:
+            slot_start = datetime.combine(today, time_slot)
+            grace_end = slot_start + timedelta(minutes=grace_minutes)
+            minutes_remaining = int((grace_end - now).total_seconds() / 60)
             
-            results.append({
-                'booking': booking,
-                'minutes_remaining': minutes_remaining,
-                'grace_expired': minutes_remaining < 0,
-                'can_report': minutes_remaining >= 0
-            })
+            results.append(PendingReport(
+                booking_id, username, seat_number, time_slot, slot_start, grace_end,
+                minutes_remaining,
+                minutes_remaining < 0,
+                minutes_remaining >= 0
+            ))
         
         return results
     
     @staticmethod
     def get_reported_today(library_id):
-        """Get all bookings that have been reported today"""
-        from datetime import date
-        
-        return Booking.query.filter(
-            Booking.library_id == library_id,
-            Booking.date == date.today(),
+        """Get all bookings that have been reported today, as DeskRow tuples"""
+        rows = ReportingService._desk_query(library_id).filter(
             Booking.is_reported == True
         ).order_by(Booking.reported_at.desc()).all()
+        
+        return [DeskRow(*row) for row in rows]
     
     @staticmethod
     def get_user_no_show_count(user_id, library_id=None, days=30):
@@ -139,24 +370,17 @@ class ReportingService:
     
     @staticmethod
     def get_upcoming_bookings_needing_report(library_id):
-        """Get bookings starting in next 30 minutes that need reporting"""
-        from datetime import date
-        
+        """Get bookings starting in next 30 minutes that need reporting, as DeskRow tuples"""
         now = datetime.now()
         thirty_min_later = now + timedelta(minutes=30)
         
-        bookings = Booking.query.filter(
-            Booking.library_id == library_id,
-            Booking.date == date.today(),
-            Booking.status == BookingStatus.booked,
-            Booking.is_reported == False
-        ).all()
+        # Window is within today; clamp at midnight
+        window_end = thirty_min_later.time() if thirty_min_later.date() == now.date() else time.max
         
-        upcoming = []
-        for booking in bookings:
-            booking_time = datetime.combine(booking.date, booking.time_slot)
-            
-            if now <= booking_time <= thirty_min_later:
-                upcoming.append(booking)
+        rows = ReportingService._desk_query(library_id).filter(
+            Booking.status == BookingStatus.booked,
+            Booking.is_reported == False,
+            Booking.time_slot.between(now.time(), window_end)
+        ).order_by(Booking.time_slot.asc()).all()
         
-        return upcoming
+        return [DeskRow(*row) for row in rows]
@@ -0,0 +1,88 @@
+"""
+Settings Registry
+Per-library SystemSettings with the day's slot grid precomputed
+"""
+
+from datetime import datetime, date, timedelta
+from models import db, SystemSettings
+from services.cache import TTLCache, MISSING
+
+SETTINGS_TTL_SECONDS = 300
+
+
+def generate_time_slots(opening_time, closing_time, slot_duration):
+    """Generate list of time slots based on library settings"""
+    slots = []
+    current = datetime.combine(date.today(), opening_time)
+    end = datetime.combine(date.today(), closing_time)
+
+    while current < end:
+        slots.append(current.time())
+        current += timedelta(minutes=slot_duration)
+
+    return slots
+
+
+class LibrarySchedule:
+    """A library's settings together with its immutable slot grid"""
+
+    __slots__ = ('settings', 'slots', 'slot_index', 'slots_per_day')
+
+    def __init__(self, settings):
+        self.settings = settings
+        self.slots = tuple(generate_time_slots(
+            settings.opening_time,
+            settings.closing_time,
+            settings.slot_duration
+        ))
+        self.slot_index = {slot: idx for idx, slot in enumerate(self.slots)}
+        self.slots_per_day = len(self.slots)
+
+
+class SettingsRegistry:
+    """Process-local cache of LibrarySchedule objects keyed by library ID"""
+
+    _cache = TTLCache(ttl=SETTINGS_TTL_SECONDS, maxsize=512)
+
+    @staticmethod
+    def get(library_id):
+        """Return the LibrarySchedule for a library, or None if it has no settings"""
+        schedule = SettingsRegistry._cache.get(library_id)
+        if schedule is MISSING:
+            settings = SystemSettings.query.filter_by(library_id=library_id).first()
+            schedule = SettingsRegistry._build(settings)
+        return schedule
+
+    @staticmethod
+    def get_many(library_ids):
+        """Return {library_id: LibrarySchedule}, loading all misses in one query"""
+        schedules = {}
+        missing = []
+        for library_id in library_ids:
+            schedule = SettingsRegistry._cache.get(library_id)
+            if schedule is MISSING:
+                missing.append(library_id)
+            else:
+                schedules[library_id] = schedule
+
+        if missing:
+            rows = SystemSettings.query.filter(SystemSettings.library_id.in_(missing)).all()
+            for settings in rows:
+                schedules[settings.library_id] = SettingsRegistry._build(settings)
+
+        return schedules
+
+    @staticmethod
+    def _build(settings):
+        if settings is None:
+            return None
+        # Detach so later commits in the request cannot expire the shared copy
+        db.session.expunge(settings)
+        schedule = LibrarySchedule(settings)
+        SettingsRegistry._cache.set(settings.library_id, schedule)
+        return schedule
+
+    @staticmethod
+    def invalidate(library_id):
+        """Drop a library's cached schedule; call after its settings change"""
+        SettingsRegistry._cache.pop(library_id)
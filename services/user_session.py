@@ -0,0 +1,153 @@
+"""
+User Session Service
+Signed identity snapshots that let Flask-Login skip the per-request User query
+"""
+
+import time as clock
+from flask import session
+from sqlalchemy.orm import make_transient_to_detached
+from models import db, User, AdminRole, ApprovalStatus, UserRole
+
+# Session key holding the snapshot. Flask signs the session cookie with
+# SECRET_KEY, so the snapshot cannot be forged client-side.
+SNAPSHOT_SESSION_KEY = '_identity'
+
+# Session key holding the library IDs whose rules the user has acknowledged.
+# Acknowledgments are never revoked, so this set only ever grows.
+RULES_ACK_SESSION_KEY = '_rules_ack'
+
+# How long a snapshot is trusted before the user row is re-read. Access
+# changes take effect on the next request in every process via
+# User.session_version; the TTL bounds how long other profile edits go unseen.
+SNAPSHOT_TTL_SECONDS = 60
+
+
+class UserSessionService:
+    """Build and restore per-session identity snapshots"""
+
+    @staticmethod
+    def load_user(user_id):
+        """
+        Flask-Login user loader backed by the session snapshot. Only the
+        user's session_version is read per request (a primary key lookup of
+        one column); the full row and permissions are re-read when it moved.
+        """
+        version = db.session.query(User.session_version).filter(User.id == user_id).scalar()
+        if version is None:
+            session.pop(SNAPSHOT_SESSION_KEY, None)
+            return None
+
+        snapshot = session.get(SNAPSHOT_SESSION_KEY)
+        if UserSessionService._is_fresh(snapshot, user_id, version):
+            return UserSessionService._restore(snapshot)
+
+        user = db.session.get(User, user_id)
+        if user is None:
+            session.pop(SNAPSHOT_SESSION_KEY, None)
+            return None
+
+        UserSessionService.store(user)
+        return user
+
+    @staticmethod
+    def _is_fresh(snapshot, user_id, version):
+        if not snapshot or snapshot.get('id') != user_id or 'permissions' not in snapshot:
+            return False
+        if clock.time() - snapshot.get('ts', 0) >= SNAPSHOT_TTL_SECONDS:
+            return False
+        return snapshot.get('v') == version
+
+    @staticmethod
+    def store(user):
+        """Write a fresh snapshot of the user into the session"""
+        # Users awaiting approval are re-read every request so that an
+        # approval takes effect on their very next click.
+        if not user.is_csr_super_admin and user.approval_status != ApprovalStatus.approved:
+            session.pop(SNAPSHOT_SESSION_KEY, None)
+            return
+
+        permission_map = user.get_permission_map()
+
+        session[SNAPSHOT_SESSION_KEY] = {
+            'id': user.id,
+            'v': user.session_version,
+            'ts': int(clock.time()),
+            'username': user.username,
+            'email': user.email,
+            'is_active': user.is_active,
+            'is_csr_super_admin': user.is_csr_super_admin,
+            'approval_status': user.approval_status.value,
+            'user_role': user.user_role.value,
+            'home_library_id': user.home_library_id,
+            # JSON object keys must be strings
+            'permissions': {str(library_id): role.value for library_id, role in permission_map.items()}
+        }
+
+    @staticmethod
+    def _restore(snapshot):
+        """Rebuild a session-bound User from a snapshot without querying"""
+        user = User(
+            id=snapshot['id'],
+            username=snapshot['username'],
+            email=snapshot['email'],
+            is_active=snapshot['is_active'],
+            is_csr_super_admin=snapshot['is_csr_super_admin'],
+            approval_status=ApprovalStatus(snapshot['approval_status']),
+            user_role=UserRole(snapshot['user_role']),
+            home_library_id=snapshot['home_library_id']
+        )
+        # Columns not in the snapshot are marked expired and load on first access
+        make_transient_to_detached(user)
+        user = db.session.merge(user, load=False)
+        user._permission_map = {
+            int(library_id): AdminRole(role)
+            for library_id, role in snapshot['permissions'].items()
+        }
+        return user
+
+    @staticmethod
+    def invalidate(user_id):
+        """
+        Force the user's snapshot (and cached permission map) to be rebuilt
+        on their next request, in every process. Call before committing
+        approval, deactivation or admin assignment changes, so the bump
+        lands in the same transaction.
+        """
+        db.session.execute(
+            db.update(User)
+            .where(User.id == user_id)
+            .values(session_version=User.session_version + 1)
+            .execution_options(synchronize_session=False)
+        )
+
+    @staticmethod
+    def get_acknowledged_libraries(user_id):
+        """Library IDs whose rules the user has accepted, queried once per session"""
+        cached = session.get(RULES_ACK_SESSION_KEY)
+        if cached and cached.get('user_id') == user_id:
+            return frozenset(cached['libraries'])
+
+        from models import UserRulesAcknowledgment
+        rows = db.session.query(UserRulesAcknowledgment.library_id).filter(
+            UserRulesAcknowledgment.user_id == user_id
+        ).all()
+        libraries = sorted(library_id for (library_id,) in rows)
+
+        session[RULES_ACK_SESSION_KEY] = {'user_id': user_id, 'libraries': libraries}
+        return frozenset(libraries)
+
+    @staticmethod
+    def add_acknowledged_library(user_id, library_id):
+        """Record a new acknowledgment in the session set"""
+        libraries = UserSessionService.get_acknowledged_libraries(user_id)
+        if library_id not in libraries:
+            session[RULES_ACK_SESSION_KEY] = {
+                'user_id': user_id,
+                'libraries': sorted(libraries | {library_id})
+            }
+
+    @staticmethod
+    def clear():
+        """Remove the cached identity state from the current session (on logout)"""
+        session.pop(SNAPSHOT_SESSION_KEY, None)
+        session.pop(RULES_ACK_SESSION_KEY, None)
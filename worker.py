@@ -0,0 +1,54 @@
+"""
+Background Worker Entry Point
+Runs scheduled and queued jobs so the web processes only serve requests
+
+Usage: python worker.py
+Run exactly as many instances as you like; each job is executed by one
+worker at a time. Every instance also runs its own no-show expiry wheel,
+which reloads itself from the database every minute.
+"""
+
+from app import create_app
+from services.job_runner import JobRunner
+from services.email_outbox import EmailOutboxService
+from services.reminder_service import ReminderService
+from services.reporting_service import ReportingService
+from services.expiry_wheel import NoShowExpiryWheel
+
+# Recurring jobs: name -> (handler, interval in seconds)
+RECURRING_JOBS = {
+    # Deliver queued notification emails
+    'send_outbox_emails': (EmailOutboxService.send_pending, 10),
+    'purge_outbox': (EmailOutboxService.purge_sent, 6 * 3600),
+    # Day-before reminders; hourly so late bookings are still reminded
+    'queue_booking_reminders': (ReminderService.queue_day_before_reminders, 3600),
+    # Safety net for anything the wheel missed
+    'auto_cancel_sweep': (ReportingService.auto_cancel_expired_bookings, 30 * 60),
+    'purge_job_history': (JobRunner.purge_history, 6 * 3600),
+}
+
+# Recurring jobs from earlier releases whose schedule rows must be removed
+RETIRED_JOBS = [
+    # Each wheel now reloads itself; as a locked job only one worker's did
+    'refresh_expiry_wheel',
+]
+
+
+def main():
+    app = create_app('production')
+
+    with app.app_context():
+        for name, (handler, interval_seconds) in RECURRING_JOBS.items():
+            JobRunner.register(name, handler)
+            JobRunner.ensure_recurring(name, interval_seconds)
+        for name in RETIRED_JOBS:
+            JobRunner.drop_recurring(name)
+
+        NoShowExpiryWheel.start(app)
+
+        print(f"✓ Worker started with {len(RECURRING_JOBS)} recurring job(s)")
+        JobRunner.run_forever()
+
+
+if __name__ == '__main__':
+    main()